@@ -1,20 +1,20 @@
+import threading
+
 import toga
 from toga.style.pack import *
 
+from pharmacy import UserParams
+from progress import ProgressThrottle, format_eta
 
-class UserParams:
-    def __init__(self):
-        self.orders_scale = 0
-        self.couriers = 0
-        self.card_sale = 0
-        self.quant_to_reorder = 0
-        self.n_days = 0
+DAILY_TABLE_ACCESSORS = ['drug', 'price', 'ordered', 'at_store']
+PAGE_SIZE = 100
 
 
 class GUI(toga.App):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.env = None
+        self.env_factory = None
         self.cur_couriers_label = None
         self.max_couriers_label = None
         self.cur_day_label = None
@@ -24,16 +24,47 @@ class GUI(toga.App):
         self.start_flag = False
         self.new_day_flag = False
         self.st_window = None
-
-    def init_env(self, env):
+        self.progress_window = None
+        self.cancelled_window = None
+        self.progress_day_label = None
+        self.progress_profit_label = None
+        self.progress_eta_label = None
+        self.cancel_event = None
+        self.worker = None
+        self.daily_stat = None
+        self.page_start = 0
+        self.page_label = None
+
+    def init_env(self, env, env_factory=None):
+        """
+        :param Env env: emulation environment
+        :param env_factory: function () -> new Env for restart after cancelled run (no restart if None)
+        """
         self.env = env
+        self.env_factory = env_factory
 
     def create_tmp_stat(self):
         # todo - add button handler
         self.main_window = toga.MainWindow(title='ежедневная статистика')
 
         data = []
-        self.drugs_daily_table = toga.Table(headings=['лекарства', 'цена', 'сегодня заказали', 'осталось'], data=data)
+        self.drugs_daily_table = toga.Table(headings=['лекарства', 'цена', 'сегодня заказали', 'осталось'],
+                                            accessors=DAILY_TABLE_ACCESSORS, data=data)
+        self.drugs_daily_table.style.flex = 1
+        self.page_start = 0
+
+        def prev_page_handler(widget):
+            self.show_page(self.page_start - PAGE_SIZE)
+
+        def next_page_handler(widget):
+            self.show_page(self.page_start + PAGE_SIZE)
+
+        self.page_label = toga.Label('', style=Pack(text_align=CENTER, padding=5))
+        page_box = toga.Box(children=[toga.Button('<', on_press=prev_page_handler), self.page_label,
+                                      toga.Button('>', on_press=next_page_handler)])
+        page_box.style.update(direction=ROW)
+        table_box = toga.Box(children=[self.drugs_daily_table, page_box])
+        table_box.style.update(direction=COLUMN)
 
         right_container = toga.Box()
         right_container.style.update(direction=COLUMN, padding_top=50)
@@ -65,20 +96,136 @@ class GUI(toga.App):
 
         split = toga.SplitContainer()
 
-        split.content = [self.drugs_daily_table, right_container]
+        split.content = [table_box, right_container]
 
         self.main_window.content = split
         self.main_window.show()
 
+    def show_page(self, start):
+        """show only rows of one page of drugs table"""
+        n_drugs = len(self.daily_stat.drug_names) if self.daily_stat is not None else 0
+        self.page_start = max(0, min(start, (n_drugs - 1) // PAGE_SIZE * PAGE_SIZE))
+        stop = min(self.page_start + PAGE_SIZE, n_drugs)
+        if self.daily_stat is not None:
+            self.drugs_daily_table.data = [self.format_row(row)
+                                           for row in self.daily_stat.rows(range(self.page_start, stop))]
+        self.page_label.text = '{}-{} из {}'.format(self.page_start + 1, stop, n_drugs)
+
+    def patch_page(self, changed_ids):
+        """update in place visible rows of changed drugs"""
+        stop = self.page_start + len(self.drugs_daily_table.data)
+        visible = changed_ids[(changed_ids >= self.page_start) & (changed_ids < stop)]
+        for drug_id, row in zip(visible.tolist(), self.daily_stat.rows(visible)):
+            table_row = self.drugs_daily_table.data[drug_id - self.page_start]
+            for accessor, value in zip(DAILY_TABLE_ACCESSORS, self.format_row(row)):
+                setattr(table_row, accessor, value)
+
+    @staticmethod
+    def format_row(row):
+        name, price, ordered, quant = row
+        return name, round(price, 2), ordered, quant
+
+    def create_progress_window(self):
+        self.progress_window = toga.Window(title='моделирование')
+
+        box = toga.Box()
+        box.style.update(direction=COLUMN, padding=20)
+        self.progress_day_label = toga.Label('номер дня', style=Pack(text_align=RIGHT))
+        box.add(self.progress_day_label)
+        self.progress_profit_label = toga.Label('прибыль', style=Pack(text_align=RIGHT))
+        box.add(self.progress_profit_label)
+        self.progress_eta_label = toga.Label('осталось времени', style=Pack(text_align=RIGHT))
+        box.add(self.progress_eta_label)
+
+        def cancel_handler(widget):
+            self.cancel_event.set()
+            widget.enabled = False
+
+        button = toga.Button('отмена', on_press=cancel_handler)
+        button.style.padding = 20
+        box.add(button)
+
+        self.progress_window.content = box
+        self.progress_window.show()
+
+    def run_to_end(self):
+        """run the rest of emulation in a worker thread, interface gets throttled progress and final statistic"""
+        self.cancel_event = threading.Event()
+        self.create_progress_window()
+
+        def show_progress(progress):
+            self.loop.call_soon_threadsafe(self.show_progress, progress)
+
+        def work():
+            final_stats = self.env.run_to_end(ProgressThrottle(show_progress), self.cancel_event)
+            self.loop.call_soon_threadsafe(self.finish_run, final_stats)
+
+        self.worker = threading.Thread(target=work, daemon=True)
+        self.worker.start()
+
+    def show_progress(self, progress):
+        self.progress_day_label.text = 'номер дня {} из {}'.format(progress.cur_day, progress.n_days)
+        self.progress_profit_label.text = 'прибыль ' + str(int(progress.total_profit))
+        self.progress_eta_label.text = 'осталось времени ' + format_eta(progress.eta)
+
+    def finish_run(self, final_stats):
+        self.worker = None
+        self.progress_window.close()
+        self.progress_window = None
+        if final_stats is not None:
+            self.show_final_statistic(final_stats)
+        else:
+            self.create_cancelled_window()
+
+    def create_cancelled_window(self):
+        """after cancel the run can be resumed from the day it stopped or started again with new parameters"""
+        self.cancelled_window = toga.Window(title='моделирование остановлено')
+
+        box = toga.Box()
+        box.style.update(direction=COLUMN, padding=20)
+        label = toga.Label('остановлено на дне {} из {}'.format(self.env.cur_day, self.env.n_days),
+                           style=Pack(text_align=RIGHT))
+        box.add(label)
+
+        def resume_handler(widget):
+            self.close_cancelled_window()
+            self.run_to_end()
+
+        button = toga.Button('продолжить', on_press=resume_handler)
+        button.style.padding = 20
+        box.add(button)
+
+        if self.env_factory is not None:
+            def restart_handler(widget):
+                self.close_cancelled_window()
+                self.env = self.env_factory()
+                # parameters can be entered again
+                self.input_flag = False
+
+            button = toga.Button('заново', on_press=restart_handler)
+            button.style.padding = 20
+            box.add(button)
+
+        self.cancelled_window.content = box
+        self.cancelled_window.show()
+
+    def close_cancelled_window(self):
+        self.cancelled_window.close()
+        self.cancelled_window = None
+
     def show_tmp_statistic(self, stat):
 
         couriers_max = stat.courier_max_load
         couriers_cur = stat.today_delivered
         cur_day = stat.cur_day
         orders = stat.today_ordered
-        drugs_info = [(item[0], round(item[1][0], 2), item[1][1], item[1][2]) for item in stat.drugs_info.items()]
-        self.drugs_daily_table.data = drugs_info
-        self.drugs_daily_table.refresh()
+        # only visible rows which changed since the previous day are patched
+        first_page = self.daily_stat is None
+        self.daily_stat = stat
+        if first_page or stat.changed_ids is None:
+            self.show_page(self.page_start)
+        else:
+            self.patch_page(stat.changed_ids)
 
         self.cur_ordered_label.text = 'сегодня заказано ' + str(orders)
 
@@ -190,7 +337,7 @@ class GUI(toga.App):
                 params.quant_to_reorder = int(n_to_reorder_input.value)
 
                 self.env.init_user_parameters(params)
-                self.env.start_next_day(no_tmp=True)
+                self.run_to_end()
 
         button = toga.Button('запустить', on_press=__start_button_handler)
         button.style.padding = 50
@@ -0,0 +1,226 @@
+import numpy as np
+
+
+class BatchStore:
+    """
+    FIFO store of drug batches for all drugs at once
+
+    every drug has a ring buffer of batches in two columns (quantity, valid_to) of 2d arrays
+    [n_drugs, capacity]; capacity grows for all drugs when some drug runs out of it.
+    batches of a drug are expected to come in order of valid_to, so the oldest batch is always the first;
+    quantities are integer or, for expected-value emulation, float (dtype=np.float64)
+    """
+    NO_BATCH = np.iinfo(np.int32).max
+
+    def __init__(self, n_drugs, capacity=2, dtype=np.int32):
+        """
+        :param int n_drugs: number of drugs
+        :param int capacity: initial number of batches per drug
+        :param dtype: type of quantities of batches
+        """
+        self.n_drugs = n_drugs
+        self.quantity = np.zeros((n_drugs, capacity), dtype=dtype)
+        self.valid_to = np.zeros((n_drugs, capacity), dtype=np.int32)
+        self.head = np.zeros(n_drugs, dtype=np.int64)
+        self.count = np.zeros(n_drugs, dtype=np.int64)
+        self.totals = np.zeros(n_drugs, dtype=np.float64 if np.issubdtype(dtype, np.floating) else np.int64)
+
+    @property
+    def capacity(self):
+        return self.quantity.shape[1]
+
+    def __grow(self, capacity):
+        """move batches of every drug to the beginning of new wider buffers"""
+        positions = (self.head[:, None] + np.arange(self.capacity)) % self.capacity
+        rows = np.arange(self.n_drugs)[:, None]
+        quantity = np.zeros((self.n_drugs, capacity), dtype=self.quantity.dtype)
+        valid_to = np.zeros((self.n_drugs, capacity), dtype=np.int32)
+        quantity[:, :self.capacity] = self.quantity[rows, positions]
+        valid_to[:, :self.capacity] = self.valid_to[rows, positions]
+        self.quantity = quantity
+        self.valid_to = valid_to
+        self.head[:] = 0
+
+    def push(self, drug_ids, quantity, valid_to):
+        """
+        put new batches to the end of drugs queues
+
+        :param np.ndarray drug_ids: drugs of batches (may repeat - batches go in given order)
+        :param np.ndarray quantity: quantities of batches
+        :param np.ndarray valid_to: last valid days of batches
+        """
+        drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        quantity = np.broadcast_to(np.asarray(quantity, dtype=self.totals.dtype), drug_ids.shape)
+        valid_to = np.broadcast_to(np.asarray(valid_to, dtype=np.int64), drug_ids.shape)
+        if len(drug_ids) == 0:
+            return
+        order = np.argsort(drug_ids, kind='stable')
+        sorted_ids = drug_ids[order]
+        first = np.searchsorted(sorted_ids, sorted_ids)
+        rank = np.empty(len(drug_ids), dtype=np.int64)
+        rank[order] = np.arange(len(drug_ids)) - first
+
+        needed = int(np.max(self.count[drug_ids] + rank)) + 1
+        if needed > self.capacity:
+            capacity = self.capacity
+            while capacity < needed:
+                capacity *= 2
+            self.__grow(capacity)
+
+        positions = (self.head[drug_ids] + self.count[drug_ids] + rank) % self.capacity
+        self.quantity[drug_ids, positions] = quantity
+        self.valid_to[drug_ids, positions] = valid_to
+        np.add.at(self.count, drug_ids, 1)
+        np.add.at(self.totals, drug_ids, quantity)
+
+    def __pop_heads(self, drug_ids):
+        """remove first batches of given drugs"""
+        self.head[drug_ids] = (self.head[drug_ids] + 1) % self.capacity
+        self.count[drug_ids] -= 1
+
+    def take(self, drug_id, needed):
+        """
+        take needed units of one drug (if possible), old batches go first
+
+        :param int drug_id:
+        :param int needed:
+        :return: int number of taken units
+        """
+        total = 0
+        capacity = self.capacity
+        while self.count[drug_id] and total < needed:
+            head = self.head[drug_id]
+            batch_quantity = int(self.quantity[drug_id, head])
+            from_cur_batch = min(needed - total, batch_quantity)
+            if from_cur_batch == batch_quantity:
+                self.head[drug_id] = (head + 1) % capacity
+                self.count[drug_id] -= 1
+            else:
+                self.quantity[drug_id, head] = batch_quantity - from_cur_batch
+            total += from_cur_batch
+        self.totals[drug_id] -= total
+        return total
+
+    def take_batches(self, drug_id, needed, min_valid_to=0):
+        """
+        take needed units of one drug (if possible) keeping their shelf life, old batches go first;
+        batches with valid_to < min_valid_to are not taken and stay on their places
+
+        :param int drug_id:
+        :param int needed:
+        :param int min_valid_to: the first last valid day of batches which may be taken
+        :return: List[(int, int)] - taken parts of batches (quantity, valid_to)
+        """
+        count = int(self.count[drug_id])
+        positions = (self.head[drug_id] + np.arange(count)) % self.capacity
+        quantities = self.quantity[drug_id, positions].tolist()
+        valid_to = self.valid_to[drug_id, positions].tolist()
+        batches = []
+        kept = []
+        total = 0
+        for i in range(count):
+            if total < needed and valid_to[i] >= min_valid_to:
+                taken = min(needed - total, quantities[i])
+                if taken:
+                    batches.append((taken, valid_to[i]))
+                total += taken
+                if taken == quantities[i]:
+                    continue
+                quantities[i] -= taken
+            kept.append(i)
+        self.quantity[drug_id, :len(kept)] = [quantities[i] for i in kept]
+        self.valid_to[drug_id, :len(kept)] = [valid_to[i] for i in kept]
+        self.head[drug_id] = 0
+        self.count[drug_id] = len(kept)
+        self.totals[drug_id] -= total
+        return batches
+
+    def units_valid_from(self, drug_ids, day):
+        """
+        :param np.ndarray drug_ids:
+        :param int day:
+        :return: np.ndarray units of every drug in batches with valid_to >= day
+        """
+        drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        offsets = (np.arange(self.capacity) - self.head[drug_ids, None]) % self.capacity
+        valid = (offsets < self.count[drug_ids, None]) & (self.valid_to[drug_ids] >= day)
+        return np.sum(np.where(valid, self.quantity[drug_ids], 0), axis=1, dtype=self.totals.dtype)
+
+    def insert(self, drug_id, quantity, valid_to):
+        """
+        put batch of one drug keeping order of valid_to (it may be older than the last one)
+
+        :param int drug_id:
+        :param int quantity:
+        :param int valid_to:
+        """
+        count = int(self.count[drug_id])
+        positions = (self.head[drug_id] + np.arange(count)) % self.capacity
+        pos = int(np.searchsorted(self.valid_to[drug_id, positions], valid_to, side='right'))
+        self.push([drug_id], [quantity], [valid_to])
+        if pos < count:
+            positions = (self.head[drug_id] + np.arange(count + 1)) % self.capacity
+            for column in (self.quantity, self.valid_to):
+                values = column[drug_id, positions]
+                column[drug_id, positions] = np.r_[values[:pos], values[-1], values[pos:-1]]
+
+    def take_many(self, drug_ids, needed):
+        """
+        take units of several different drugs at once, old batches go first
+
+        :param np.ndarray drug_ids: different drugs
+        :param np.ndarray needed: needed units of every drug
+        :return: np.ndarray number of taken units of every drug
+        """
+        drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        rest = np.asarray(needed, dtype=self.totals.dtype).copy()
+        active = np.flatnonzero((self.count[drug_ids] > 0) & (rest > 0))
+        while len(active):
+            ids = drug_ids[active]
+            heads = self.head[ids]
+            batch_quantity = self.quantity[ids, heads].astype(self.totals.dtype)
+            from_cur_batch = np.minimum(rest[active], batch_quantity)
+            rest[active] -= from_cur_batch
+            self.quantity[ids, heads] = batch_quantity - from_cur_batch
+            self.__pop_heads(ids[from_cur_batch == batch_quantity])
+            active = active[(self.count[ids] > 0) & (rest[active] > 0)]
+        taken = np.asarray(needed, dtype=self.totals.dtype) - rest
+        self.totals[drug_ids] -= taken
+        return taken
+
+    def first_valid_to(self, drug_ids=None):
+        """
+        last valid day of the oldest batch of drugs; NO_BATCH for drugs without batches
+
+        :param np.ndarray drug_ids: drugs (all if None)
+        :return: np.ndarray
+        """
+        if drug_ids is None:
+            drug_ids = np.arange(self.n_drugs)
+        drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        res = self.valid_to[drug_ids, self.head[drug_ids]].astype(np.int64)
+        res[self.count[drug_ids] == 0] = self.NO_BATCH
+        return res
+
+    def expire(self, day, drug_ids=None):
+        """
+        remove all batches with valid_to < day
+
+        :param int day:
+        :param np.ndarray drug_ids: drugs to check (all if None)
+        :return: Tuple(np.ndarray, np.ndarray) - drugs with removed batches and removed quantity for every drug
+        """
+        if drug_ids is None:
+            drug_ids = np.arange(self.n_drugs)
+        drug_ids = np.unique(np.asarray(drug_ids, dtype=np.int64))
+        expired = np.zeros(len(drug_ids), dtype=self.totals.dtype)
+        active = np.flatnonzero(self.first_valid_to(drug_ids) < day)
+        removed = np.zeros(len(drug_ids), dtype=bool)
+        removed[active] = True
+        while len(active):
+            ids = drug_ids[active]
+            expired[active] += self.quantity[ids, self.head[ids]]
+            self.__pop_heads(ids)
+            active = active[self.first_valid_to(ids) < day]
+        self.totals[drug_ids] -= expired
+        return drug_ids[removed], expired[removed]
@@ -0,0 +1,225 @@
+import numpy as np
+
+from catalog import DrugCatalog
+from demand import LogisticDemand
+from orders import OrderBatch
+from pharmacy import (AVERAGE_DRUGS_IN_ORDER, CARD_PROBA, MAX_COURIER_ORDERS, MAX_WAITING_TIME, MIN_WAITING_TIME,
+                      ORDER_VAR, FinalStat, load_recurring_orders, make_recurring_schedule)
+from settlement import SaleRules, allocate_fifo, settle_orders
+from simulation import child_seeds
+from virtual_store import VirtualStore
+
+
+class BatchedEnv:
+    """
+    several replicas of the same pharmacy emulated together in one process
+
+    every per-drug state (stock, prices, markups, waiting reorders, demand; see VirtualStore) is a flat array
+    of n_replicas * n_drugs values indexed by virtual drug id = replica * n_drugs + drug id, so demand
+    generation, settlement, store checks and repricing of all replicas are single array operations.
+    the model is the same as of Env, replicas are independent and statistically equivalent
+    to Env runs, but random streams of Env are not reproduced
+    """
+    def __init__(self, drugs_file, orders_file, params, n_replicas, seed=None, demand_model=None):
+        """
+        :param drugs_file: file with drugs, compiled catalog directory or DrugCatalog
+        :param str orders_file: file with repeating orders
+        :param UserParams params: emulation parameters (the same for all replicas)
+        :param int n_replicas: number of replicas
+        :param seed: int or np.random.SeedSequence for reproducible run; None for random one
+        :param DemandModel demand_model: demand curve; LogisticDemand if None
+        """
+        catalog = drugs_file if isinstance(drugs_file, DrugCatalog) else DrugCatalog.open(drugs_file)
+        self.catalog = catalog
+        self.n_replicas = n_replicas
+        self.n_drugs = len(catalog)
+        self.n_days = params.n_days
+        self.cur_day = 0
+        demand_seed, supplier_seed = child_seeds(seed, 2)
+        self.__rng = np.random.default_rng(demand_seed)
+        self.__supplier_rng = np.random.default_rng(supplier_seed)
+        self.__demand_model = demand_model if demand_model is not None else LogisticDemand()
+        self.__store = VirtualStore(catalog, n_replicas, self.__demand_model, params.quant_to_reorder)
+
+        self.__order_scale = params.orders_scale
+        self.__sale_rules = SaleRules(card_sale=params.card_sale)
+        self.__courier_max_load = params.couriers * MAX_COURIER_ORDERS
+        self.__recurring_orders = make_recurring_schedule(load_recurring_orders(orders_file, catalog))
+
+        self.__total_profit = np.zeros(n_replicas)
+        self.__total_delivered = np.zeros(n_replicas, dtype=np.int64)
+        self.__ordered_history = []
+
+    def run(self):
+        """
+        emulate all days of all replicas
+
+        :return: List[FinalStat] - statistics of every replica
+        """
+        while self.cur_day < self.n_days:
+            self.__daily_routine()
+            self.cur_day += 1
+        return self.get_final_stats()
+
+    def __daily_routine(self):
+        """the same steps as Env.__daily_routine and Pharmacy.new_day for all replicas at once"""
+        self.__store.deliver(self.cur_day)
+
+        purchases = self.__rng.poisson(self.__generate_purchases())
+        # pharmacy day starts after generation of orders
+        pharmacy_day = self.cur_day + 1
+        orders = self.__generate_orders(purchases)
+        orders = self.__add_recurring_orders(orders, pharmacy_day)
+        self.__process_orders(*orders)
+
+        reorder_ids, add_sale, remove_sale = self.__store.check(pharmacy_day)
+        self.__order_drugs(reorder_ids)
+        self.__store.update_prices(add_sale, remove_sale)
+
+    def __generate_purchases(self):
+        """average purchases of every virtual drug for the day"""
+        day_factor = self.__demand_model.day_factor(self.cur_day)
+        if isinstance(day_factor, np.ndarray):
+            day_factor = np.tile(day_factor, self.n_replicas)
+        return self.__order_scale * self.__store.intensity * day_factor
+
+    def __generate_orders(self, purchases):
+        """
+        split purchases of every replica into orders
+
+        units of every replica are shuffled by one sort on random keys and cut into consecutive
+        chunks of generated order sizes (as in Randomizer);
+        every unit is a line of its order - giving stock to lines one by one is the same
+        as giving it to lines with summed quantities
+
+        :param np.ndarray purchases: purchased units of every virtual drug
+        :return: (lines_order, lines_drug, lines_quant, order_replica, has_card) - orders of all
+            replicas grouped by replica
+        """
+        totals = purchases.reshape(self.n_replicas, self.n_drugs).sum(axis=1)
+        sizes = self.__generate_orders_sizes(totals)
+        n_orders = np.count_nonzero(sizes, axis=1)
+        used = sizes.sum(axis=1)
+
+        units = np.repeat(np.arange(len(purchases)), purchases)
+        units_replica = self.__store.group_of[units]
+        # replica + uniform key keeps replicas apart and shuffles units inside every replica
+        units = units[np.argsort(units_replica + self.__rng.random(len(units)))]
+        rank = np.arange(len(units)) - (np.cumsum(totals) - totals)[units_replica]
+        units = units[rank < used[units_replica]]
+
+        order_sizes = sizes[sizes > 0]
+        lines_order = np.repeat(np.arange(len(order_sizes)), order_sizes)
+        order_replica = np.repeat(np.arange(self.n_replicas), n_orders)
+        has_card = self.__rng.random(len(order_sizes)) < CARD_PROBA
+        return lines_order, units, np.ones(len(units), dtype=np.int64), order_replica, has_card
+
+    def __generate_orders_sizes(self, totals):
+        """
+        sizes of orders of every replica; the last order takes the rest of units,
+        non positive size finishes the day of the replica
+
+        :param np.ndarray totals: purchased units of every replica
+        :return: np.ndarray [n_replicas, k] - sizes of orders of every replica padded with zeros
+        """
+        batch = int(np.max(totals, initial=0)) // max(AVERAGE_DRUGS_IN_ORDER - ORDER_VAR, 1) + 16
+        sizes = np.empty((self.n_replicas, 0), dtype=np.int64)
+        while True:
+            new_sizes = np.round(self.__rng.normal(AVERAGE_DRUGS_IN_ORDER, ORDER_VAR,
+                                                   (self.n_replicas, batch)))
+            sizes = np.concatenate((sizes, new_sizes.astype(np.int64)), axis=1)
+            valid = np.logical_and.accumulate(sizes > 0, axis=1)
+            cum_sizes = np.cumsum(np.where(valid, sizes, 0), axis=1)
+            if np.all((cum_sizes[:, -1] >= totals) | ~valid[:, -1]):
+                break
+        n_orders = np.minimum(np.count_nonzero(cum_sizes < totals[:, None], axis=1) + 1, valid.sum(axis=1))
+        n_orders[totals == 0] = 0
+        sizes = np.where(np.arange(sizes.shape[1]) < n_orders[:, None], sizes, 0)
+        rows = np.flatnonzero(n_orders)
+        last = n_orders[rows] - 1
+        sizes[rows, last] -= np.maximum(cum_sizes[rows, last] - totals[rows], 0)
+        return sizes
+
+    def __add_recurring_orders(self, orders, pharmacy_day):
+        """
+        append orders of loyal clients (the same for every replica) after client orders
+
+        :return: orders with the same fields and loyal flag of every order
+        """
+        lines_order, lines_drug, lines_quant, order_replica, has_card = orders
+        loyal = np.zeros(len(order_replica), dtype=bool)
+        recurring = OrderBatch.from_orders(self.__recurring_orders.pop_due(pharmacy_day), loyal=True)
+        if not len(recurring):
+            return lines_order, lines_drug, lines_quant, order_replica, has_card, loyal
+        replicas = np.arange(self.n_replicas)[:, None]
+        n_client_orders = len(order_replica)
+        lines_order = np.concatenate((lines_order, (n_client_orders + recurring.lines_order()[None, :]
+                                                    + replicas * len(recurring)).ravel()))
+        lines_drug = np.concatenate((lines_drug, (recurring.drug_ids[None, :] + replicas * self.n_drugs).ravel()))
+        lines_quant = np.concatenate((lines_quant, np.tile(recurring.quantity, self.n_replicas)))
+        order_replica = np.concatenate((order_replica, np.repeat(replicas[:, 0], len(recurring))))
+        has_card = np.concatenate((has_card, np.tile(recurring.has_card, self.n_replicas)))
+        loyal = np.concatenate((loyal, np.ones(self.n_replicas * len(recurring), dtype=bool)))
+        return lines_order, lines_drug, lines_quant, order_replica, has_card, loyal
+
+    def __process_orders(self, lines_order, lines_drug, lines_quant, order_replica, has_card, loyal):
+        """
+        settle orders of all replicas, deliver the first ready orders of every replica up to couriers load
+
+        client orders of every replica go before its loyal ones in lines, so stock is given in the same order
+        as in Pharmacy
+        """
+        n_orders = len(order_replica)
+        store = self.__store
+        drugs_ordered = np.bincount(lines_drug, weights=lines_quant,
+                                    minlength=len(store.cur_prices)).astype(np.int64)
+        allocated = allocate_fifo(lines_drug, lines_quant, store.drug_store.totals)
+        ordered_ids = np.flatnonzero(drugs_ordered)
+        store.take(ordered_ids, drugs_ordered[ordered_ids])
+
+        cur_income, profit = settle_orders(lines_order, lines_drug, allocated, n_orders, store.base_prices,
+                                           store.cur_prices, has_card, loyal, self.__sale_rules)
+        ready = np.flatnonzero(cur_income != 0)
+        # client orders precede loyal ones inside replica; ready is sorted by order index
+        ready = ready[np.argsort(order_replica[ready], kind='stable')]
+        ready_replica = order_replica[ready]
+        first = np.searchsorted(ready_replica, ready_replica)
+        delivered = ready[np.arange(len(ready)) - first < self.__courier_max_load]
+
+        n_ready = np.bincount(ready_replica, minlength=self.n_replicas)
+        self.__ordered_history.append(n_ready)
+        self.__total_delivered += np.minimum(n_ready, self.__courier_max_load)
+        self.__total_profit += np.bincount(order_replica[delivered], weights=profit[delivered],
+                                           minlength=self.n_replicas)
+
+    def __order_drugs(self, drug_ids):
+        """place reorders with random waiting times"""
+        waiting = np.round(self.__supplier_rng.uniform(MIN_WAITING_TIME, MAX_WAITING_TIME,
+                                                       len(drug_ids))).astype(np.int64)
+        self.__store.order(drug_ids, self.cur_day + waiting)
+
+    def get_final_stats(self):
+        """
+        final statistics of every replica; courier load aggregates are exact (not sketched)
+
+        :return: List[FinalStat]
+        """
+        history = np.array(self.__ordered_history, dtype=np.float64).reshape(-1, self.n_replicas)
+        loads = history / self.__courier_max_load if self.__courier_max_load else np.zeros_like(history)
+        stats = []
+        for replica in range(self.n_replicas):
+            load = loads[:, replica]
+            stat = FinalStat()
+            stat.courier_max_load = self.__courier_max_load
+            stat.total_profit = float(self.__total_profit[replica])
+            stat.total_lost = float(self.__store.lost[replica])
+            stat.days = len(load)
+            stat.courier_load_mean = float(load.mean()) if len(load) else 0.0
+            stat.courier_load_std = float(load.std(ddof=1)) if len(load) > 1 else 0.0
+            stat.courier_load_max = float(load.max()) if len(load) else 0.0
+            stat.courier_load_quantiles = {q: float(np.quantile(load, q)) if len(load) else None
+                                           for q in (0.5, 0.9, 0.99)}
+            stat.total_delivered = int(self.__total_delivered[replica])
+            stats.append(stat)
+        return stats
+
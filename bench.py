@@ -0,0 +1,251 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from catalog import compile_catalog
+from profiling import profiler
+from simulation import Simulation, make_user_params
+from sweep import parse_values
+
+BENCH_FORMAT_VERSION = 1
+
+
+class BenchCase:
+    """struct: one point of benchmark matrix"""
+    def __init__(self, n_drugs, n_subscribers, orders_scale, n_days, couriers=10, card_sale=0.05,
+                 quant_to_reorder=10):
+        self.n_drugs = n_drugs
+        self.n_subscribers = n_subscribers
+        self.orders_scale = orders_scale
+        self.n_days = n_days
+        self.couriers = couriers
+        self.card_sale = card_sale
+        self.quant_to_reorder = quant_to_reorder
+
+    @property
+    def key(self):
+        """name of the case for comparison of result files"""
+        return 'drugs={} subscribers={} scale={} days={}'.format(self.n_drugs, self.n_subscribers,
+                                                                 self.orders_scale, self.n_days)
+
+    def user_params(self):
+        return make_user_params(self.n_days, self.orders_scale, self.couriers, self.card_sale,
+                                self.quant_to_reorder)
+
+
+def generate_catalog(filename, n_drugs, seed=0):
+    """
+    write synthetic ';' separated drugs file: log-normal prices, markups 5-50%, standard batches 10-100,
+    shelf lives from a month to two years
+
+    :param str filename:
+    :param int n_drugs:
+    :param int seed:
+    """
+    rng = np.random.default_rng(seed)
+    prices = np.clip(rng.lognormal(5, 1, n_drugs), 10, 5000).astype(np.int64)
+    profits = np.round(rng.uniform(1.05, 1.5, n_drugs), 2)
+    quantities = rng.integers(10, 101, n_drugs)
+    shelf_lives = rng.integers(30, 731, n_drugs)
+    with open(filename, 'w') as file:
+        file.write('name;price;profit;quant;life\n')
+        file.writelines('drug{};{};{};{};{}\n'.format(i, price, profit, quant, life) for i, price, profit, quant, life
+                        in zip(range(n_drugs), prices.tolist(), profits.tolist(), quantities.tolist(),
+                               shelf_lives.tolist()))
+
+
+def generate_recurring(filename, n_subscribers, n_drugs, seed=0):
+    """
+    write synthetic file of repeating orders: 1-5 drugs of 1-3 units, periods 1-30 days
+
+    :param str filename:
+    :param int n_subscribers:
+    :param int n_drugs: size of catalog the orders are drawn from
+    :param int seed:
+    """
+    rng = np.random.default_rng(seed)
+    with open(filename, 'w') as file:
+        file.write('drugs;period;name;address;phone;id\n')
+        for i in range(n_subscribers):
+            n_lines = int(rng.integers(1, 6))
+            drugs = rng.choice(n_drugs, size=min(n_lines, n_drugs), replace=False).tolist()
+            quants = rng.integers(1, 4, len(drugs)).tolist()
+            file.write('{};{};client{};address{};{};{}\n'.format(
+                '.'.join('drug{},{}'.format(drug, quant) for drug, quant in zip(drugs, quants)),
+                int(rng.integers(1, 31)), i, i, 70000000000 + i, 100000 + i))
+
+
+def prepare_data(data_dir, n_drugs, n_subscribers, seed=0):
+    """
+    generate (once) compiled catalog and repeating orders of the given size
+
+    :return: (str, str) - compiled catalog directory and orders file
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    drugs_file = os.path.join(data_dir, 'drugs_{}_{}.txt'.format(n_drugs, seed))
+    catalog_dir = drugs_file[:-len('.txt')] + '.cat'
+    orders_file = os.path.join(data_dir, 'orders_{}_{}_{}.txt'.format(n_drugs, n_subscribers, seed))
+    if not os.path.isdir(catalog_dir):
+        generate_catalog(drugs_file, n_drugs, seed)
+        compile_catalog(drugs_file, catalog_dir)
+    if not os.path.exists(orders_file):
+        generate_recurring(orders_file, n_subscribers, n_drugs, seed)
+    return catalog_dir, orders_file
+
+
+def peak_rss_mb():
+    """:return: float peak resident memory of this process (MB)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_case(case, data_dir, seed=0, repeat=1):
+    """
+    run one case headless with fixed seed; the best of repeats is reported
+
+    :param BenchCase case:
+    :param str data_dir: directory for generated data
+    :param int seed: seed of data and emulation
+    :param int repeat: number of runs
+    :return: dict
+    """
+    catalog_dir, orders_file = prepare_data(data_dir, case.n_drugs, case.n_subscribers, seed)
+    params = case.user_params()
+    best = None
+    for _ in range(repeat):
+        profiler.reset()
+        profiler.enable()
+        start = time.perf_counter()
+        simulation = Simulation(catalog_dir, orders_file, params, seed=seed)
+        loaded = time.perf_counter()
+        stat = simulation.run()
+        finished = time.perf_counter()
+        profiler.enable(False)
+        if best is None or finished - loaded < best['run_sec']:
+            summary = profiler.summary()
+            best = {'load_sec': loaded - start,
+                    'run_sec': finished - loaded,
+                    'orders': summary['counters'].get('orders', 0),
+                    'phases': {name: phase['total'] for name, phase in summary['phases'].items()},
+                    'total_profit': stat.total_profit}
+    best['days_per_sec'] = case.n_days / best['run_sec']
+    best['orders_per_sec'] = best['orders'] / best['run_sec']
+    best['peak_rss_mb'] = peak_rss_mb()
+    best.update(case.__dict__)
+    best['key'] = case.key
+    return best
+
+
+def run_suite(cases, data_dir, seed=0, repeat=1, isolate=True):
+    """
+    :param list[BenchCase] cases:
+    :param str data_dir: directory for generated data (reused between runs)
+    :param int seed:
+    :param int repeat: runs of every case
+    :param bool isolate: run every case in a fresh process, so peak memory belongs to the case
+    :return: dict - environment description and results of cases
+    """
+    if isolate:
+        results = []
+        for case in cases:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results.append(executor.submit(run_case, case, data_dir, seed, repeat).result())
+    else:
+        results = [run_case(case, data_dir, seed, repeat) for case in cases]
+    return {'version': BENCH_FORMAT_VERSION,
+            'env': {'python': platform.python_version(), 'numpy': np.__version__,
+                    'machine': platform.machine(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'seed': seed,
+            'results': results}
+
+
+def compare(base, new, threshold=0.1):
+    """
+    compare throughput of the same cases in two result files
+
+    :param dict base: results of run_suite
+    :param dict new: results of run_suite
+    :param float threshold: relative slowdown of days per second treated as regression
+    :return: (list, bool) - rows (key, base days/sec, new days/sec, ratio) and flag of regression
+    """
+    base_results = {result['key']: result for result in base['results']}
+    rows = []
+    regression = False
+    for result in new['results']:
+        old = base_results.get(result['key'])
+        if old is None:
+            continue
+        ratio = result['days_per_sec'] / old['days_per_sec']
+        regression |= ratio < 1 - threshold
+        rows.append((result['key'], old['days_per_sec'], result['days_per_sec'], ratio))
+    return rows, regression
+
+
+def format_results(suite):
+    lines = ['{:<48}{:>12}{:>14}{:>10}  {}'.format('case', 'days/sec', 'orders/sec', 'RSS, MB', 'top phases')]
+    for result in suite['results']:
+        top = sorted([item for item in result['phases'].items() if item[0] != 'day'], key=lambda item: -item[1])
+        phases = ', '.join('{} {:.0%}'.format(name, total / result['run_sec']) for name, total in top[:3])
+        lines.append('{:<48}{:>12.1f}{:>14.0f}{:>10.1f}  {}'.format(
+            result['key'], result['days_per_sec'], result['orders_per_sec'], result['peak_rss_mb'], phases))
+    return '\n'.join(lines)
+
+
+def format_comparison(rows, threshold):
+    lines = ['{:<48}{:>12}{:>12}{:>9}'.format('case', 'base d/s', 'new d/s', 'ratio')]
+    for key, old, new, ratio in rows:
+        mark = '  REGRESSION' if ratio < 1 - threshold else ''
+        lines.append('{:<48}{:>12.1f}{:>12.1f}{:>9.2f}{}'.format(key, old, new, ratio, mark))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark of emulation core on synthetic data')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run benchmark matrix')
+    run.add_argument('--drugs', type=parse_values, default=[1000, 10000], help='catalog sizes, comma separated')
+    run.add_argument('--subscribers', type=parse_values, default=[0, 1000],
+                     help='numbers of repeating orders, comma separated')
+    run.add_argument('--orders-scale', type=parse_values, default=[1, 10], help='values, comma separated')
+    run.add_argument('--n-days', type=parse_values, default=[100], help='horizons, comma separated')
+    run.add_argument('--repeat', type=int, default=3, help='runs of every case (the best is reported)')
+    run.add_argument('--seed', type=int, default=0, help='seed of data and emulation')
+    run.add_argument('--data-dir', default='bench_data', help='directory for generated data')
+    run.add_argument('--no-isolate', action='store_true', help='run cases in this process')
+    run.add_argument('-o', '--output', default=None, help='json file for results')
+    cmp = commands.add_parser('compare', help='compare two result files')
+    cmp.add_argument('base', help='json file of base results')
+    cmp.add_argument('new', help='json file of new results')
+    cmp.add_argument('--threshold', type=float, default=0.1, help='relative slowdown treated as regression')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.base) as file:
+            base = json.load(file)
+        with open(args.new) as file:
+            new = json.load(file)
+        rows, regression = compare(base, new, args.threshold)
+        print(format_comparison(rows, args.threshold))
+        return 1 if regression else 0
+
+    cases = [BenchCase(n_drugs, n_subscribers, scale, n_days) for n_drugs, n_subscribers, scale, n_days
+             in itertools.product(args.drugs, args.subscribers, args.orders_scale, args.n_days)]
+    suite = run_suite(cases, args.data_dir, args.seed, args.repeat, not args.no_isolate)
+    print(format_results(suite))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(suite, file, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
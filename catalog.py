@@ -0,0 +1,169 @@
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+CATALOG_FORMAT_VERSION = 1
+
+
+class DrugCatalog:
+    """
+    catalog of drugs: names are interned to dense integer ids once at load time,
+    drugs parameters are stored in parallel arrays indexed by drug id
+    """
+    def __init__(self, names, prices, profits, quantities, shelf_lives):
+        """
+        :param names: list of drug names or callable returning it (for lazy decoding)
+        :param prices: base (purchase) prices
+        :param profits: base markups
+        :param quantities: standard quantities of batch
+        :param shelf_lives: shelf lives of batch (days)
+        """
+        self.__names = list(names) if not callable(names) else None
+        self.__names_loader = names if callable(names) else None
+        self.prices = np.asarray(prices)
+        self.profits = np.asarray(profits, dtype=np.float64)
+        self.quantities = np.asarray(quantities, dtype=np.int64)
+        self.shelf_lives = np.asarray(shelf_lives, dtype=np.int64)
+        self.__ids = None
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_DrugCatalog__names'] = self.names
+        state['_DrugCatalog__names_loader'] = None
+        return state
+
+    @property
+    def names(self):
+        """list of drug names (decoded at the first call for compiled catalog)"""
+        if self.__names is None:
+            self.__names = self.__names_loader()
+            self.__names_loader = None
+        return self.__names
+
+    def id_of(self, name):
+        """
+        :param str name: drug name
+        :return: int drug id
+        """
+        if self.__ids is None:
+            self.__ids = {name: i for i, name in enumerate(self.names)}
+        return self.__ids[name]
+
+    def name_of(self, drug_id):
+        """
+        :param int drug_id:
+        :return: str drug name
+        """
+        return self.names[drug_id]
+
+    @classmethod
+    def from_csv(cls, filename):
+        """
+        open and parse file with drug information
+
+        :param str filename: ';' separated file with header: name;price;profit;quantity;shelf_life
+        :return: DrugCatalog
+        """
+        names = []
+        prices = []
+        profits = []
+        quants = []
+        life = []
+        with open(filename) as file:
+            reader = csv.reader(file, delimiter=';')
+            reader.__next__()
+            for line in reader:
+                names.append(line[0])
+                prices.append(int(line[1]))
+                profits.append(float(line[2]))
+                quants.append(int(line[3]))
+                life.append(int(line[4]))
+        return cls(names, prices, profits, quants, life)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        open compiled catalog (see compile_catalog); with mmap arrays are read-only views
+        of files shared by all processes which open them
+
+        :param str path: directory of compiled catalog
+        :param bool mmap: map files to memory instead of reading
+        :return: DrugCatalog
+        """
+        with open(os.path.join(path, 'catalog.json')) as file:
+            header = json.load(file)
+        if header['version'] != CATALOG_FORMAT_VERSION:
+            raise ValueError('unsupported catalog version ' + str(header['version']))
+        mmap_mode = 'r' if mmap else None
+
+        def column(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+        def names():
+            blob = column('names')
+            offsets = column('name_offsets')
+            data = bytes(blob)
+            return [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+        return cls(names, column('price'), column('profit'), column('quantity'), column('shelf_life'))
+
+    @classmethod
+    def open(cls, path):
+        """
+        :param str path: compiled catalog directory or ';' separated file
+        :return: DrugCatalog
+        """
+        if os.path.isdir(path):
+            return cls.load(path)
+        return cls.from_csv(path)
+
+    def save(self, path):
+        """
+        write catalog in compiled columnar format: one .npy file per column, names as utf-8 blob with offsets
+
+        :param str path: directory
+        """
+        os.makedirs(path, exist_ok=True)
+        encoded = [name.encode('utf-8') for name in self.names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=offsets[1:])
+        np.save(os.path.join(path, 'names.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(path, 'name_offsets.npy'), offsets)
+        np.save(os.path.join(path, 'price.npy'), np.asarray(self.prices))
+        np.save(os.path.join(path, 'profit.npy'), np.asarray(self.profits))
+        np.save(os.path.join(path, 'quantity.npy'), np.asarray(self.quantities))
+        np.save(os.path.join(path, 'shelf_life.npy'), np.asarray(self.shelf_lives))
+        with open(os.path.join(path, 'catalog.json'), 'w') as file:
+            json.dump({'version': CATALOG_FORMAT_VERSION, 'n_drugs': len(self)}, file)
+
+
+def compile_catalog(src, dst):
+    """
+    compile ';' separated catalog into memory-mapped columnar format once
+
+    :param str src: ';' separated file
+    :param str dst: directory for compiled catalog
+    :return: DrugCatalog
+    """
+    catalog = DrugCatalog.from_csv(src)
+    catalog.save(dst)
+    return catalog
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='compile drugs catalog into memory-mapped format')
+    parser.add_argument('src', help="';' separated file with drugs")
+    parser.add_argument('dst', help='directory for compiled catalog')
+    args = parser.parse_args(argv)
+    catalog = compile_catalog(args.src, args.dst)
+    print('compiled {} drugs to {}'.format(len(catalog), args.dst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import pickle
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from simulation import child_seeds
+
+SNAPSHOT_MAGIC = b'PHSNAP1'
+
+
+def save_snapshot(env, path, compress=True):
+    """
+    save full emulation state: pharmacy store, prices, waiting reorders, recurring orders schedule,
+    supplier queue, current day and state of random generators
+
+    :param Env env: emulation to save (interface is not saved)
+    :param str path: file name
+    :param bool compress: compress state with zlib
+    """
+    data = pickle.dumps(env, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(path, 'wb') as file:
+        file.write(SNAPSHOT_MAGIC)
+        file.write(b'z' if compress else b'-')
+        file.write(zlib.compress(data, 1) if compress else data)
+
+
+def load_snapshot(path, gui=None):
+    """
+    restore emulation exactly as it was saved (the same random streams);
+    snapshot is a pickle - load only trusted files
+
+    :param str path: file name
+    :param gui: interface for restored emulation
+    :return: Env
+    """
+    with open(path, 'rb') as file:
+        magic = file.read(len(SNAPSHOT_MAGIC))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(path + ' is not an emulation snapshot')
+        compressed = file.read(1) == b'z'
+        data = file.read()
+    env = pickle.loads(zlib.decompress(data) if compressed else data)
+    env.GUI = gui
+    return env
+
+
+def fork_snapshot(path, seed, params=None):
+    """
+    restore emulation and continue it with new random streams
+
+    :param str path: file name
+    :param seed: int or np.random.SeedSequence for the continuation
+    :param UserParams params: new parameters for the continuation (n_days is the last day of it);
+        saved ones if None
+    :return: Env
+    """
+    env = load_snapshot(path)
+    demand_seed, supplier_seed = child_seeds(seed, 2)
+    env.randomizer.set_rng(np.random.default_rng(demand_seed), np.random.default_rng(supplier_seed))
+    if params is not None:
+        env.init_user_parameters(params)
+    return env
+
+
+def run_fork(path, seed, params=None):
+    """
+    run one continuation of saved emulation to the end (executed in a worker process)
+
+    :return: FinalStat
+    """
+    return fork_snapshot(path, seed, params).start_next_day(no_tmp=True)
+
+
+def run_forks(path, n_forks, seed=None, params=None, workers=None):
+    """
+    run independent continuations of saved emulation in a process pool
+
+    :param str path: snapshot file name
+    :param int n_forks: number of continuations
+    :param seed: root seed; every continuation gets its own stream spawned from it
+    :param UserParams params: parameters for continuations (saved ones if None)
+    :param int workers: number of processes (all cores if None)
+    :return: List[FinalStat]
+    """
+    seeds = child_seeds(seed, n_forks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_fork, [path] * n_forks, seeds, [params] * n_forks))
@@ -0,0 +1,92 @@
+import math
+
+import numpy as np
+
+
+class DemandModel:
+    """
+    demand curve: average purchases of drugs per day as function of prices and markups
+
+    intensity is calculated for arrays of drugs at once and is cached by randomizer,
+    day_factor lets the curve change in time without recalculation of intensity
+    """
+    def intensity(self, prices, profits):
+        """
+        average purchases of drugs per unit of orders scale
+
+        :param np.ndarray prices: base prices of drugs
+        :param np.ndarray profits: current markups of drugs
+        :return: np.ndarray
+        """
+        raise NotImplementedError
+
+    def day_factor(self, day):
+        """
+        multiplier of intensity for the day
+
+        :param int day: number of emulated day
+        :return: float or np.ndarray (for every drug)
+        """
+        return 1.0
+
+
+class LogisticDemand(DemandModel):
+    """demand falls as logistic function of log(price * markup^2)"""
+    def intensity(self, prices, profits):
+        arg = prices * (profits ** 2)
+        arg = -np.log(arg) * 2 + 12
+        return np.exp(arg) / (1 + np.exp(arg))
+
+
+class SeasonalDemand(DemandModel):
+    """other demand curve with sinusoidal seasonal multiplier"""
+    def __init__(self, base_model=None, amplitude=0.2, period=365, phase=0):
+        """
+        :param DemandModel base_model: curve to modulate (LogisticDemand if None)
+        :param float amplitude: relative amplitude of seasonal changes
+        :param int period: season length (days)
+        :param int phase: shift of season (days)
+        """
+        self.base_model = base_model if base_model is not None else LogisticDemand()
+        self.amplitude = amplitude
+        self.period = period
+        self.phase = phase
+
+    def intensity(self, prices, profits):
+        return self.base_model.intensity(prices, profits)
+
+    def day_factor(self, day):
+        season = 1 + self.amplitude * np.sin(2 * np.pi * (day + self.phase) / self.period)
+        return season * self.base_model.day_factor(day)
+
+
+def poisson_ppf(u, lam):
+    """
+    inverse CDF of Poisson distribution: the least k with P(X <= k) >= u, so monotone
+    in u (antithetic 1 - u gives negatively correlated draws)
+
+    probabilities are summed from 8 standard deviations below the mean (the mass below is neglected)
+
+    :param np.ndarray u: uniform values in [0, 1)
+    :param np.ndarray lam: means of the same shape
+    :return: np.ndarray
+    """
+    u = np.asarray(u, dtype=np.float64)
+    shape = u.shape
+    lam = np.broadcast_to(np.asarray(lam, dtype=np.float64), shape).ravel()
+    u = u.ravel()
+    k = np.floor(np.maximum(lam - 8 * np.sqrt(lam), 0))
+    log_lam = np.log(np.where(lam > 0, lam, 1))
+    log_p = -lam + k * log_lam
+    shifted = np.flatnonzero(k > 0)
+    log_p[shifted] -= [math.lgamma(x + 1) for x in k[shifted].tolist()]
+    p = np.where(lam > 0, np.exp(log_p), np.where(k == 0, 1.0, 0.0))
+    cdf = p.copy()
+    active = np.flatnonzero(u > cdf)
+    limit = lam + 8 * np.sqrt(lam) + 20
+    while len(active):
+        k[active] += 1
+        p[active] *= lam[active] / k[active]
+        cdf[active] += p[active]
+        active = active[(u[active] > cdf[active]) & (k[active] < limit[active])]
+    return k.astype(np.int64).reshape(shape)
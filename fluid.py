@@ -0,0 +1,328 @@
+import statistics
+
+import numpy as np
+
+from catalog import DrugCatalog
+from demand import LogisticDemand
+from orders import OrderBatch
+from pharmacy import (AVERAGE_DRUGS_IN_ORDER, CARD_PROBA, MAX_COURIER_ORDERS, MAX_WAITING_TIME, MIN_WAITING_TIME,
+                      ORDER_VAR, FinalStat, load_recurring_orders, make_recurring_schedule)
+from replication import run_replications
+from settlement import SaleRules, allocate_fifo, settle_orders
+from simulation import build_arg_parser, courier_load, format_final_stat, make_user_params
+from virtual_store import VirtualStore
+
+
+class FluidEnv:
+    """
+    deterministic expected-value ("fluid") emulation of several parameters configurations at once
+
+    random draws are replaced by their expectations: every drug is bought in expected quantity
+    (fractional units), orders have the expected size, card owners are the expected share of orders
+    and every reorder waits the mean lead time; stock, write-offs, markdowns, reorders and couriers load
+    follow the rules of Pharmacy (VirtualStore as in BatchedEnv: state of configuration k, drug i is at
+    virtual drug id = k * n_drugs + i). repeating orders are integer and go as in Pharmacy.
+
+    the result is an approximation for quick screening: threshold rules (reorder, couriers limit)
+    react to the mean instead of averaging over fluctuations, so configurations near a threshold
+    are biased - compare candidates with Monte Carlo runs (see compare_with_monte_carlo)
+
+    measured error against means of 20 Monte Carlo runs (300 drugs, 40 repeating orders, 120 days,
+    card sale 5%):
+
+        orders scale  couriers  reorder  fluid profit  mc profit +- 95%   error  fluid lost   mc lost
+                   1         3        3        -57809   -61890 +-  9974   +6.6%     1592801   1638662
+                   1         3       20       -298740  -278448 +- 12167   -7.3%     2068221   2140750
+                   1        30        3        -22822   -12103 +-  9074  -88.6%     1592801   1638662
+                   1        30       20       -259012  -245941 +- 10906   -5.3%     2068221   2140750
+                   5         3        3        220779   226882 +- 14752   -2.7%       27616     49902
+                   5         3       20          4994    -1615 +-  9813    +409%      158019    246274
+                   5        30        3        679528   732071 +- 44164   -7.2%       27616     49902
+                   5        30       20         73646    66761 +- 33699  +10.3%      158019    246274
+                  20         3        3        409075   389265 +- 12152   +5.1%           0      3181
+                  20         3       20        190466   184830 +- 16639   +3.0%           0     42886
+                  20        30        3       1595530  1594385 +- 81649   +0.1%           0      3181
+                  20        30       20        754056   758288 +- 86244   -0.6%           0     42886
+
+    median profit error is 6%, 7 of 12 values are inside the Monte Carlo interval; large relative errors
+    are of profits near zero (absolute error 7k-11k). the ranking of configurations is the same
+    (Spearman 1.0). write-offs are underestimated (unsold stock left by demand fluctuations is not seen)
+    and small ones come out as 0; mean couriers load is within 0.06.
+
+    fluid emulation is not orders of magnitude faster per configuration: one configuration takes
+    about 0.1 s against 0.16 s of one stochastic run (both pay the same per-day array overhead).
+    the gain is one evaluation instead of many replications and many configurations in one run:
+    12 configurations above take 0.23 s against 33 s of Monte Carlo runs, 192 configurations 10 ms each
+    """
+    def __init__(self, drugs_file, orders_file, params_list, demand_model=None):
+        """
+        :param drugs_file: file with drugs, compiled catalog directory or DrugCatalog
+        :param str orders_file: file with repeating orders
+        :param list[UserParams] params_list: configurations (n_days of the first one is used for all)
+        :param DemandModel demand_model: demand curve; LogisticDemand if None
+        """
+        catalog = drugs_file if isinstance(drugs_file, DrugCatalog) else DrugCatalog.open(drugs_file)
+        self.catalog = catalog
+        self.n_configs = len(params_list)
+        self.n_drugs = len(catalog)
+        self.n_days = params_list[0].n_days
+        self.cur_day = 0
+        self.__demand_model = demand_model if demand_model is not None else LogisticDemand()
+
+        # order sizes are round(normal): probability that size is not positive (it finishes the day)
+        # and mean positive size
+        normal = statistics.NormalDist(AVERAGE_DRUGS_IN_ORDER, ORDER_VAR)
+        self.__stop_proba = normal.cdf(0.5)
+        sizes = np.arange(1, AVERAGE_DRUGS_IN_ORDER + 10 * ORDER_VAR + 1)
+        size_proba = np.array([normal.cdf(k + 0.5) - normal.cdf(k - 0.5) for k in sizes.tolist()])
+        self.__order_size = float(np.dot(sizes, size_proba) / size_proba.sum())
+        # round(uniform(min, max)) has the mean of its bounds
+        self.__waiting_time = round((MIN_WAITING_TIME + MAX_WAITING_TIME) / 2)
+
+        self.__order_scale = np.array([params.orders_scale for params in params_list], dtype=np.float64)
+        self.__sale_rules = SaleRules(card_sale=np.array([params.card_sale for params in params_list],
+                                                         dtype=np.float64))
+        self.__courier_max_load = np.array([params.couriers * MAX_COURIER_ORDERS for params in params_list],
+                                           dtype=np.float64)
+        min_quant_to_reorder = np.repeat([params.quant_to_reorder for params in params_list], self.n_drugs)
+        self.__store = VirtualStore(catalog, self.n_configs, self.__demand_model, min_quant_to_reorder,
+                                    dtype=np.float64)
+        self.__recurring_orders = make_recurring_schedule(load_recurring_orders(orders_file, catalog))
+
+        self.__total_profit = np.zeros(self.n_configs)
+        self.__total_delivered = np.zeros(self.n_configs)
+        self.__ordered_history = []
+
+    def run(self):
+        """
+        emulate all days of all configurations
+
+        :return: List[FinalStat] - approximate statistics of every configuration
+        """
+        while self.cur_day < self.n_days:
+            self.__daily_routine()
+            self.cur_day += 1
+        return self.get_final_stats()
+
+    def __daily_routine(self):
+        """the same steps as Env.__daily_routine and Pharmacy.new_day with expected values"""
+        self.__store.deliver(self.cur_day)
+
+        # pharmacy day starts after generation of orders
+        pharmacy_day = self.cur_day + 1
+        purchases, needed = self.__expected_orders()
+        n_ready, n_delivered, ready_share = self.__process_client_orders(purchases, needed)
+        recurring_ready, recurring_delivered = self.__process_recurring_orders(pharmacy_day, needed, ready_share)
+        self.__ordered_history.append(n_ready + recurring_ready)
+        self.__total_delivered += n_delivered + recurring_delivered
+
+        reorder_ids, add_sale, remove_sale = self.__store.check(pharmacy_day)
+        self.__store.order(reorder_ids, np.full(len(reorder_ids), self.cur_day + self.__waiting_time))
+        self.__store.update_prices(add_sale, remove_sale)
+
+    def __expected_min(self, n):
+        """
+        orders are generated until units run out or until a not positive size, so the number of orders
+        is min(K, n) for n orders needed, K is geometric: E[min(K, n)] = q (1 - q^n) / (1 - q),
+        q - probability of positive size
+
+        :param np.ndarray n: (fractional) number of orders
+        :return: np.ndarray
+        """
+        positive = 1 - self.__stop_proba
+        return positive * (1 - positive ** n) / self.__stop_proba
+
+    def __expected_orders(self):
+        """
+        expected purchases which get into orders (every unit is dropped with the same probability
+        when orders stop early, see __expected_min)
+
+        :return: (np.ndarray, np.ndarray) - units of every virtual drug and orders needed for all
+            expected units of every configuration
+        """
+        day_factor = self.__demand_model.day_factor(self.cur_day)
+        if isinstance(day_factor, np.ndarray):
+            day_factor = np.tile(day_factor, self.n_configs)
+        configs = self.__store.group_of
+        average = self.__order_scale[configs] * self.__store.intensity * day_factor
+        totals = np.bincount(configs, weights=average, minlength=self.n_configs)
+        needed = totals / self.__order_size
+        kept = np.divide(self.__expected_min(needed), needed, out=np.zeros_like(needed), where=needed > 0)
+        return average * kept[configs], needed
+
+    def __process_client_orders(self, purchases, needed):
+        """
+        sell expected purchases from stock; an order is ready if any of its units is in stock,
+        the first ready orders up to couriers load are delivered (ready orders have the same mean profit)
+
+        the number of orders varies a lot from day to day, so delivered orders are E[min(r min(K, n), load)]
+        = r E[min(K, min(n, load / r))] for ready share r, not the load limit of expected orders
+
+        :return: (np.ndarray, np.ndarray, np.ndarray) - ready and delivered orders and ready share of orders
+            of every configuration
+        """
+        store = self.__store
+        n_orders = self.__expected_min(needed)
+        ordered_ids = np.flatnonzero(purchases > 0)
+        taken = store.take(ordered_ids, purchases[ordered_ids])
+        sold = np.zeros(len(purchases))
+        sold[ordered_ids] = taken
+
+        configs = store.group_of
+        units = np.bincount(configs, weights=purchases, minlength=self.n_configs)
+        filled = np.bincount(configs, weights=sold, minlength=self.n_configs)
+        missed = 1 - np.divide(filled, units, out=np.zeros_like(units), where=units > 0)
+        order_size = np.divide(units, n_orders, out=np.zeros_like(units), where=n_orders > 0)
+        ready_share = 1 - missed ** order_size
+        n_ready = n_orders * ready_share
+        limit = np.minimum(needed, np.divide(self.__courier_max_load, ready_share, out=np.full_like(needed, np.inf),
+                                             where=ready_share > 0))
+        n_delivered = ready_share * self.__expected_min(limit)
+
+        income = sold * store.cur_prices
+        base_income = sold * store.base_prices
+        # an order is big if its unit with the price and the rest of average units exceed the threshold
+        mean_price = np.divide(np.bincount(configs, weights=purchases * store.cur_prices, minlength=self.n_configs),
+                               units, out=np.zeros_like(units), where=units > 0)
+        big = store.cur_prices + (order_size - 1)[configs] * mean_price[configs] > self.__sale_rules.big_order_thre
+        total_income = np.bincount(configs, weights=income, minlength=self.n_configs)
+        big_income = np.bincount(configs, weights=income * big, minlength=self.n_configs)
+        sales = CARD_PROBA * self.__sale_rules.card_sale * total_income + \
+            (1 - CARD_PROBA) * self.__sale_rules.big_order_sale * big_income
+        profit = total_income - sales - np.bincount(configs, weights=base_income, minlength=self.n_configs)
+        share = np.divide(n_delivered, n_ready, out=np.zeros_like(n_ready), where=n_ready > 0)
+        self.__total_profit += profit * share
+        return n_ready, n_delivered, ready_share
+
+    def __process_recurring_orders(self, pharmacy_day, needed, ready_share):
+        """
+        settle orders of loyal clients (the same for every configuration) after client orders;
+        the rest of couriers load goes to the first ready of them
+
+        the load is left only on days with few client orders, so j-th ready order is delivered
+        with probability P(r min(K, n) < load - j) (see __process_client_orders)
+
+        :return: (np.ndarray, np.ndarray) - ready and delivered orders of every configuration
+        """
+        recurring = OrderBatch.from_orders(self.__recurring_orders.pop_due(pharmacy_day), loyal=True)
+        n_recurring = len(recurring)
+        if not n_recurring:
+            return np.zeros(self.n_configs), np.zeros(self.n_configs)
+        configs = np.arange(self.n_configs)[:, None]
+        lines_order = (recurring.lines_order()[None, :] + configs * n_recurring).ravel()
+        lines_drug = (recurring.drug_ids[None, :] + configs * self.n_drugs).ravel()
+        lines_quant = np.tile(recurring.quantity, self.n_configs)
+        order_config = np.repeat(configs[:, 0], n_recurring)
+
+        # whole units only: only allocated units leave the store, the fraction stays for client orders
+        store = self.__store
+        allocated = allocate_fifo(lines_drug, lines_quant, np.floor(store.drug_store.totals + 1e-9))
+        drugs_allocated = np.bincount(lines_drug, weights=allocated, minlength=len(store.cur_prices))
+        ordered_ids = np.flatnonzero(drugs_allocated)
+        store.take(ordered_ids, drugs_allocated[ordered_ids])
+
+        rules = SaleRules(card_sale=self.__sale_rules.card_sale[order_config])
+        cur_income, profit = settle_orders(lines_order, lines_drug, allocated, len(order_config),
+                                           store.base_prices, store.cur_prices,
+                                           np.tile(recurring.has_card, self.n_configs),
+                                           np.ones(len(order_config), dtype=bool), rules)
+        ready = cur_income != 0
+        rank = np.cumsum(ready.reshape(self.n_configs, n_recurring), axis=1).ravel() - 1
+        free = (self.__courier_max_load[order_config] - rank).astype(np.float64)
+        share = ready_share[order_config]
+        orders = np.divide(free, share, out=np.full_like(free, np.inf), where=share > 0)
+        chance = np.where(orders > needed[order_config], 1.0, 1 - (1 - self.__stop_proba) ** orders)
+        delivered = np.where(ready & (free > 0), chance, 0)
+        self.__total_profit += np.bincount(order_config, weights=profit * delivered, minlength=self.n_configs)
+        return (np.bincount(order_config, weights=ready, minlength=self.n_configs),
+                np.bincount(order_config, weights=delivered, minlength=self.n_configs))
+
+    def get_final_stats(self):
+        """
+        approximate final statistics of every configuration; courier load is of expected ready orders
+
+        :return: List[FinalStat]
+        """
+        history = np.array(self.__ordered_history, dtype=np.float64).reshape(-1, self.n_configs)
+        max_load = np.where(self.__courier_max_load > 0, self.__courier_max_load, np.inf)
+        loads = history / max_load
+        stats = []
+        for config in range(self.n_configs):
+            load = loads[:, config]
+            stat = FinalStat()
+            stat.courier_max_load = int(self.__courier_max_load[config])
+            stat.total_profit = float(self.__total_profit[config])
+            stat.total_lost = float(self.__store.lost[config])
+            stat.days = len(load)
+            stat.courier_load_mean = float(load.mean()) if len(load) else 0.0
+            stat.courier_load_std = float(load.std(ddof=1)) if len(load) > 1 else 0.0
+            stat.courier_load_max = float(load.max()) if len(load) else 0.0
+            stat.courier_load_quantiles = {q: float(np.quantile(load, q)) if len(load) else None
+                                           for q in (0.5, 0.9, 0.99)}
+            stat.total_delivered = float(self.__total_delivered[config])
+            stats.append(stat)
+        return stats
+
+
+def run_fluid(drugs_file, orders_file, params):
+    """
+    expected-value approximation of a run; see FluidEnv for its measured error and speed
+
+    :param str drugs_file: file with drugs
+    :param str orders_file: file with repeating orders
+    :param UserParams params: emulation parameters
+    :return: FinalStat - expected-value approximation of a run
+    """
+    return FluidEnv(drugs_file, orders_file, [params]).run()[0]
+
+
+def compare_with_monte_carlo(drugs_file, orders_file, params_list, n_runs=10, seed=None, workers=None):
+    """
+    error of expected-value emulation against means of stochastic runs
+
+    :param str drugs_file: file with drugs
+    :param str orders_file: file with repeating orders
+    :param list[UserParams] params_list: configurations
+    :param int n_runs: replications per configuration
+    :param seed: root seed of replications
+    :param int workers: number of processes (all cores if None)
+    :return: List[(FinalStat, ReplicationStat)] - fluid and Monte Carlo statistics of every configuration
+    """
+    fluid_stats = FluidEnv(drugs_file, orders_file, params_list).run()
+    return [(stat, run_replications(drugs_file, orders_file, params, n_runs, seed, workers))
+            for stat, params in zip(fluid_stats, params_list)]
+
+
+def format_comparison(rows):
+    """
+    :param list rows: result of compare_with_monte_carlo
+    :return: str text table: fluid value, Monte Carlo mean and its interval for profit, lost and couriers load
+    """
+    lines = ['{:>14}{:>14}{:>12}{:>14}{:>14}{:>12}{:>8}{:>8}'.format(
+        'fluid profit', 'mc profit', '+-', 'fluid lost', 'mc lost', '+-', 'fl load', 'mc load')]
+    for stat, mc in rows:
+        lines.append('{:>14.0f}{:>14.0f}{:>12.0f}{:>14.0f}{:>14.0f}{:>12.0f}{:>8.2f}{:>8.2f}'.format(
+            stat.total_profit, mc.total_profit.mean, mc.total_profit.half_width, stat.total_lost,
+            mc.total_lost.mean, mc.total_lost.half_width, courier_load(stat), mc.courier_load.mean))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = build_arg_parser()
+    parser.description = 'deterministic expected-value pharmacy emulation'
+    parser.add_argument('--compare-runs', type=int, default=0,
+                        help='also run this number of stochastic replications and compare')
+    args = parser.parse_args(argv)
+    params = make_user_params(args.n_days, args.orders_scale, args.couriers, args.card_sale / 100.0,
+                              args.quant_to_reorder)
+    if args.compare_runs:
+        rows = compare_with_monte_carlo(args.drugs_file, args.orders_file, [params], args.compare_runs, args.seed)
+        print(format_comparison(rows))
+        return rows
+    stat = run_fluid(args.drugs_file, args.orders_file, params)
+    print(format_final_stat(stat))
+    return stat
+
+
+if __name__ == '__main__':
+    main()
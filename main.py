@@ -1,14 +1,18 @@
-from GUI import GUI
 from pharmacy import Env
 from pharmacy import Randomizer
 
 
 if __name__ == '__main__':
+    # toga is heavy and needs a display, so it is imported only for the interactive app
+    from GUI import GUI
+
     drugs_file = 'drugs_big.txt'
     orders_file = 'reccuring.txt'
 
     gui = GUI('GUI', 'org.beeware.gui')
     randomizer = Randomizer
     env = Env(GUI=gui, randomizer_cls=randomizer, drugs_file=drugs_file, orders_file=orders_file)
-    gui.init_env(env)
+    # restart after cancelled run gets fresh environment with already loaded catalog
+    gui.init_env(env, lambda: Env(GUI=gui, randomizer_cls=randomizer, drugs_file=env.catalog,
+                                  orders_file=orders_file))
     gui.main_loop()
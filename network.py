@@ -0,0 +1,320 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from catalog import DrugCatalog
+from pharmacy import Pharmacy, Randomizer, Supplier, load_recurring_orders
+from simulation import child_seeds, courier_load, make_user_params
+from stat_sink import AggregateSink
+
+
+class StoreNode:
+    """one pharmacy of the network with its own clients; supplier is shared and lives in the coordinator"""
+    def __init__(self, catalog, recurring_orders, params, seed, reserve=0.5, randomizer_cls=Randomizer):
+        """
+        :param DrugCatalog catalog:
+        :param list recurring_orders: see load_recurring_orders
+        :param UserParams params: parameters of the store (n_days is ignored)
+        :param np.random.SeedSequence seed: seed of the store demand
+        :param float reserve: part of standard quantity kept above reorder threshold when giving drugs away
+        :param randomizer_cls: randomizer class
+        """
+        self.catalog = catalog
+        self.reserve = np.ceil(catalog.quantities * reserve).astype(np.int64)
+        self.randomizer = randomizer_cls(rng=np.random.default_rng(seed))
+        self.randomizer.init_params(catalog.prices, catalog.profits)
+        self.randomizer.init_user_params(params.orders_scale)
+        self.pharmacy = Pharmacy(catalog, recurring_orders, AggregateSink())
+        self.pharmacy.init_user_params(params.couriers, params.card_sale, params.quant_to_reorder)
+
+    def step(self, delivered, received):
+        """
+        one day of the store
+
+        :param np.ndarray delivered: ids of drugs delivered by supplier
+        :param list received: [(drug_id, batches)] - drugs transferred from other stores
+        :return: np.ndarray ids of reordered drugs
+        """
+        self.pharmacy.deliver_drugs(delivered)
+        for drug_id, batches in received:
+            self.pharmacy.receive_transfer(drug_id, batches)
+
+        self.pharmacy.new_day(self.randomizer.start_new_day_batch())
+        reorders = np.array([order.drug for order in self.pharmacy.get_drugs_orders()], dtype=np.int64)
+        self.randomizer.update_profits(self.pharmacy.get_profits())
+        return reorders
+
+    def surplus(self, requested):
+        """
+        :param np.ndarray requested: ids of drugs reordered in the network today
+        :return: np.ndarray surplus of requested drugs
+        """
+        return self.pharmacy.surplus(requested, self.reserve[requested])
+
+    def send(self, to_send):
+        """
+        :param list to_send: [(drug_id, quantity, to_store)] - transfers to other stores
+        :return: list [(to_store, drug_id, batches)] - sent transfers
+        """
+        sent = []
+        for drug_id, quantity, to_store in to_send:
+            batches = self.pharmacy.send_transfer(drug_id, quantity)
+            if batches:
+                sent.append((to_store, drug_id, batches))
+        return sent
+
+    def final(self):
+        """:return: FinalStat"""
+        return self.pharmacy.get_final_stats()
+
+
+class NetworkStat:
+    """struct: final statistics of every store and of the whole network"""
+    def __init__(self, store_stats, transferred, seconds_per_day):
+        """
+        :param list[FinalStat] store_stats: statistics of every store
+        :param int transferred: units of drugs transferred between stores
+        :param float seconds_per_day: mean wall-clock time of one emulated day
+        """
+        self.store_stats = store_stats
+        self.total_profit = sum(stat.total_profit for stat in store_stats)
+        self.total_lost = sum(stat.total_lost for stat in store_stats)
+        self.transferred = transferred
+        self.seconds_per_day = seconds_per_day
+
+    def __repr__(self):
+        lines = ['store {}: profit {:.2f}, lost {:.2f}, mean courier load {:.2f}'.format(
+            i, stat.total_profit, stat.total_lost, courier_load(stat)) for i, stat in enumerate(self.store_stats)]
+        lines += ['total profit: {:.2f}'.format(self.total_profit),
+                  'total lost: {:.2f}'.format(self.total_lost),
+                  'transferred units: {}'.format(self.transferred),
+                  'seconds per day: {:.4f}'.format(self.seconds_per_day)]
+        return '\n'.join(lines)
+
+
+def _build_stores(drugs_file, orders_file, specs, reserve):
+    """
+    :param list specs: [(store index, UserParams, seed)]
+    :param float reserve: see StoreNode
+    :return: dict store index -> StoreNode
+    """
+    catalog = drugs_file if isinstance(drugs_file, DrugCatalog) else DrugCatalog.open(drugs_file)
+    recurring_orders = load_recurring_orders(orders_file, catalog)
+    return {i: StoreNode(catalog, recurring_orders, params, seed, reserve) for i, params, seed in specs}
+
+
+def _call_stores(stores, method, args):
+    """
+    :param dict stores: store index -> StoreNode
+    :param str method: name of StoreNode method ('step', 'surplus' or 'send')
+    :param dict args: store index -> tuple of arguments of the method
+    :return: dict store index -> result of the method
+    """
+    return {i: getattr(store, method)(*args[i]) for i, store in stores.items()}
+
+
+def _serve_shard(conn, drugs_file, orders_file, specs, reserve):
+    """
+    worker process loop: owns a shard of stores and executes commands of the coordinator
+
+    commands: ('call', method, args) -> results of StoreNode method, ('final',) -> final statistics, ('stop',)
+    """
+    stores = _build_stores(drugs_file, orders_file, specs, reserve)
+    while True:
+        command = conn.recv()
+        if command[0] == 'call':
+            conn.send(_call_stores(stores, command[1], command[2]))
+        elif command[0] == 'final':
+            conn.send({i: store.final() for i, store in stores.items()})
+        else:
+            break
+    conn.close()
+
+
+class NetworkSimulation:
+    """
+    headless emulation of network of pharmacies which advance day by day in lock-step;
+    stores are sharded across worker processes, the coordinator owns the shared supplier
+    and matches transfers between stores; they exchange compact messages at the end of every day
+    """
+    def __init__(self, drugs_file, orders_file, stores, n_days, seed=None, workers=None, transfers=False,
+                 reserve=0.5):
+        """
+        :param str drugs_file: file with drugs or compiled catalog directory (mapped once per worker)
+        :param str orders_file: file with repeating orders (the same for every store)
+        :param list[UserParams] stores: parameters of every store
+        :param int n_days: emulation period (days)
+        :param seed: root seed: every store and the supplier get their own streams spawned from it
+        :param int workers: number of worker processes (all cores if None, 0 - run in this process)
+        :param bool transfers: move surplus of drugs to stores which have reordered them
+        :param float reserve: part of standard quantity which donor keeps above its reorder threshold
+        """
+        self.drugs_file = drugs_file
+        self.orders_file = orders_file
+        self.n_days = n_days
+        self.transfers = transfers
+        self.reserve = reserve
+        self.n_stores = len(stores)
+        seeds = child_seeds(seed, self.n_stores + 1)
+        self.specs = [(i, params, seeds[i]) for i, params in enumerate(stores)]
+        supplier_randomizer = Randomizer(supplier_rng=np.random.default_rng(seeds[-1]))
+        self.supplier = Supplier(supplier_randomizer.generate_waiting_time)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = min(workers, self.n_stores)
+        self.quantities = None
+
+    def run(self):
+        """
+        emulate all days of all stores
+
+        :return: NetworkStat
+        """
+        if self.workers:
+            shards = [self.specs[i::self.workers] for i in range(self.workers)]
+            return self.__run_sharded(shards)
+        stores = _build_stores(self.drugs_file, self.orders_file, self.specs, self.reserve)
+        self.quantities = next(iter(stores.values())).catalog.quantities
+        return self.__run_days(lambda method, args: _call_stores(stores, method, args),
+                               lambda: {i: store.final() for i, store in stores.items()})
+
+    def __run_sharded(self, shards):
+        context = multiprocessing.get_context()
+        conns = []
+        processes = []
+        for shard in shards:
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_serve_shard,
+                                      args=(child_conn, self.drugs_file, self.orders_file, shard, self.reserve),
+                                      daemon=True)
+            process.start()
+            child_conn.close()
+            conns.append((parent_conn, {i for i, _, _ in shard}))
+            processes.append(process)
+        catalog = self.drugs_file if isinstance(self.drugs_file, DrugCatalog) else DrugCatalog.open(self.drugs_file)
+        self.quantities = catalog.quantities
+
+        def call(method, args):
+            for conn, indices in conns:
+                conn.send(('call', method, {i: args[i] for i in indices}))
+            results = {}
+            for conn, _ in conns:
+                results.update(conn.recv())
+            return results
+
+        def final():
+            for conn, _ in conns:
+                conn.send(('final',))
+            results = {}
+            for conn, _ in conns:
+                results.update(conn.recv())
+            return results
+
+        try:
+            return self.__run_days(call, final)
+        finally:
+            for conn, _ in conns:
+                conn.send(('stop',))
+                conn.close()
+            for process in processes:
+                process.join()
+
+    def __run_days(self, call, final):
+        """
+        lock-step loop: send messages of the day to every store, then wait for all of them
+
+        reorders of the day are first offered to other stores: transfers are matched and sent the same day
+        and arrive the next morning, not later than the earliest supplier delivery; a reorder filled
+        by a transfer is not placed at supplier
+
+        :param call: function (method, args) -> dict store index -> result of StoreNode method (see _call_stores)
+        :param final: function () -> dict store index -> FinalStat
+        :return: NetworkStat
+        """
+        in_transit = {i: [] for i in range(self.n_stores)}
+        transferred = 0
+        start = time.perf_counter()
+        for cur_day in range(self.n_days):
+            delivered = {i: [] for i in range(self.n_stores)}
+            for store, drug_id in self.supplier.pop_due(cur_day):
+                delivered[store].append(drug_id)
+            reorders = call('step', {i: (np.array(delivered[i], dtype=np.int64), in_transit[i])
+                                     for i in range(self.n_stores)})
+            requests = [(i, drug_id) for i in range(self.n_stores) for drug_id in reorders[i].tolist()]
+
+            in_transit = {i: [] for i in range(self.n_stores)}
+            filled = set()
+            if self.transfers and requests:
+                requested = np.unique(np.array([drug_id for _, drug_id in requests], dtype=np.int64))
+                surplus = call('surplus', {i: (requested,) for i in range(self.n_stores)})
+                to_send = self.__match_transfers(requested, requests, surplus)
+                sent = call('send', {i: (to_send[i],) for i in range(self.n_stores)})
+                for i in range(self.n_stores):
+                    for to_store, drug_id, batches in sent[i]:
+                        in_transit[to_store].append((drug_id, batches))
+                        filled.add((to_store, drug_id))
+                        transferred += sum(quantity for quantity, _ in batches)
+            for request in requests:
+                if request not in filled:
+                    self.supplier.order(cur_day, request)
+        seconds_per_day = (time.perf_counter() - start) / self.n_days if self.n_days else 0.0
+
+        store_stats = final()
+        return NetworkStat([store_stats[i] for i in range(self.n_stores)], transferred, seconds_per_day)
+
+    def __match_transfers(self, requested, requests, surplus):
+        """
+        give every request the drug from the store with the largest surplus (not more than standard quantity)
+
+        :param np.ndarray requested: ids of requested drugs
+        :param list requests: [(store, drug_id)] - reorders of today
+        :param dict surplus: store index -> surplus of requested drugs
+        :return: dict store index -> [(drug_id, quantity, to_store)]
+        """
+        to_send = {i: [] for i in range(self.n_stores)}
+        surplus = np.stack([surplus[i] for i in range(self.n_stores)])
+        columns = {drug_id: j for j, drug_id in enumerate(requested.tolist())}
+        for store, drug_id in requests:
+            column = surplus[:, columns[drug_id]]
+            candidates = column.copy()
+            candidates[store] = 0
+            donor = int(np.argmax(candidates))
+            quantity = min(int(candidates[donor]), int(self.quantities[drug_id]))
+            if quantity > 0:
+                to_send[donor].append((drug_id, quantity, store))
+                column[donor] -= quantity
+        return to_send
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='headless emulation of network of pharmacies')
+    parser.add_argument('drugs_file', help='file with drugs or compiled catalog directory')
+    parser.add_argument('orders_file', help='file with repeating orders')
+    parser.add_argument('--stores', type=int, default=4, help='number of stores')
+    parser.add_argument('--n-days', type=int, required=True, help='emulation period (days)')
+    parser.add_argument('--orders-scale', type=float, nargs='+', required=True,
+                        help='orders flow density of stores (the last one is repeated)')
+    parser.add_argument('--couriers', type=int, required=True, help='number of couriers of every store')
+    parser.add_argument('--card-sale', type=float, required=True, help='sale for card owners (%%)')
+    parser.add_argument('--quant-to-reorder', type=int, required=True,
+                        help='minimal quantity of drug before reorder')
+    parser.add_argument('--transfers', action='store_true', help='transfer surplus of drugs between stores')
+    parser.add_argument('--reserve', type=float, default=0.5,
+                        help='part of standard quantity which donor keeps above reorder threshold')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (0 - no processes)')
+    parser.add_argument('--seed', type=int, default=None, help='seed for reproducible run')
+    args = parser.parse_args(argv)
+    scales = args.orders_scale + [args.orders_scale[-1]] * max(args.stores - len(args.orders_scale), 0)
+    stores = [make_user_params(args.n_days, scale, args.couriers, args.card_sale / 100.0, args.quant_to_reorder)
+              for scale in scales[:args.stores]]
+    stat = NetworkSimulation(args.drugs_file, args.orders_file, stores, args.n_days, seed=args.seed,
+                             workers=args.workers, transfers=args.transfers, reserve=args.reserve).run()
+    print(stat)
+    return stat
+
+
+if __name__ == '__main__':
+    main()
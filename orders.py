@@ -0,0 +1,167 @@
+import numpy as np
+
+
+class OrderBatch:
+    """
+    client orders of one day in flat arrays
+
+    drug lines of orders are stored CSR-like: lines of order i are indptr[i]:indptr[i+1]
+    in drug_ids / quantity / ready columns
+    """
+    def __init__(self, meta, card_ids, loyal, indptr, drug_ids, quantity):
+        """
+        :param list meta: (name, address, phone_number) of every order
+        :param card_ids: card id or None of every order
+        :param loyal: bool for every order - order from loyal client
+        :param indptr: start of lines of every order and end of the last one
+        :param drug_ids: drug id of every line
+        :param quantity: ordered quantity of every line
+        """
+        self.meta = meta
+        self.card_ids = np.asarray(card_ids, dtype=object)
+        self.has_card = np.array([bool(card_id) for card_id in self.card_ids], dtype=bool)
+        self.loyal = np.asarray(loyal, dtype=bool)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        self.quantity = np.asarray(quantity, dtype=np.int64)
+        self.ready = np.zeros(len(self.drug_ids), dtype=np.int64)
+        self.total_profit = np.zeros(len(self.meta), dtype=np.float64)
+        self.delivered = np.zeros(len(self.meta), dtype=bool)
+
+    def __len__(self):
+        return len(self.meta)
+
+    def __getitem__(self, i):
+        return OrderView(self, i)
+
+    def __iter__(self):
+        return (OrderView(self, i) for i in range(len(self)))
+
+    @property
+    def n_lines(self):
+        return len(self.drug_ids)
+
+    def lines_order(self):
+        """:return: np.ndarray order index of every line"""
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def select(self, indices):
+        """
+        :param np.ndarray indices: indices of orders
+        :return: OrderSlice - view of orders, not a copy
+        """
+        return OrderSlice(self, indices)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [0], [], [])
+
+    @classmethod
+    def from_orders(cls, orders, loyal=None):
+        """
+        :param orders: objects with client_name, address, phone_number, card_id, drugs(dict) and loyal_client
+        :param bool loyal: loyal flag for all orders (taken from orders if None)
+        :return: OrderBatch
+        """
+        lengths = [len(order.drugs) for order in orders]
+        indptr = np.zeros(len(orders) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        return cls([(order.client_name, order.address, order.phone_number) for order in orders],
+                   [order.card_id for order in orders],
+                   [order.loyal_client if loyal is None else loyal for order in orders],
+                   indptr,
+                   np.fromiter((drug_id for order in orders for drug_id in order.drugs.keys()),
+                               dtype=np.int64, count=indptr[-1]),
+                   np.fromiter((quant for order in orders for quant in order.drugs.values()),
+                               dtype=np.int64, count=indptr[-1]))
+
+    @classmethod
+    def concat(cls, batches):
+        """
+        :param list[OrderBatch] batches: batches without settlement results
+        :return: OrderBatch with orders of all batches in given order
+        """
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+        offsets = np.cumsum([0] + [batch.n_lines for batch in batches[:-1]])
+        indptr = np.concatenate([[0]] + [batch.indptr[1:] + offset for batch, offset in zip(batches, offsets)])
+        meta = []
+        for batch in batches:
+            meta += batch.meta
+        return cls(meta,
+                   np.concatenate([batch.card_ids for batch in batches]),
+                   np.concatenate([batch.loyal for batch in batches]),
+                   indptr,
+                   np.concatenate([batch.drug_ids for batch in batches]),
+                   np.concatenate([batch.quantity for batch in batches]))
+
+
+class OrderView:
+    """lightweight view of one order of OrderBatch with the same fields as ClientOrder"""
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def client_name(self):
+        return self.batch.meta[self.index][0]
+
+    @property
+    def address(self):
+        return self.batch.meta[self.index][1]
+
+    @property
+    def phone_number(self):
+        return self.batch.meta[self.index][2]
+
+    @property
+    def card_id(self):
+        return self.batch.card_ids[self.index]
+
+    @property
+    def loyal_client(self):
+        return bool(self.batch.loyal[self.index])
+
+    @property
+    def drugs(self):
+        lines = slice(self.batch.indptr[self.index], self.batch.indptr[self.index + 1])
+        return dict(zip(self.batch.drug_ids[lines].tolist(), self.batch.quantity[lines].tolist()))
+
+    @property
+    def ready_drugs(self):
+        lines = slice(self.batch.indptr[self.index], self.batch.indptr[self.index + 1])
+        return {drug_id: ready for drug_id, ready in zip(self.batch.drug_ids[lines].tolist(),
+                                                          self.batch.ready[lines].tolist()) if ready > 0}
+
+    @property
+    def total_profit(self):
+        return float(self.batch.total_profit[self.index])
+
+    @property
+    def if_delivered(self):
+        return bool(self.batch.delivered[self.index])
+
+
+class OrderSlice:
+    """sequence of orders of OrderBatch given by indices"""
+    __slots__ = ('batch', 'indices')
+
+    def __init__(self, batch, indices):
+        self.batch = batch
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return OrderSlice(self.batch, self.indices[i])
+        return OrderView(self.batch, int(self.indices[i]))
+
+    def __iter__(self):
+        return (OrderView(self.batch, i) for i in self.indices.tolist())
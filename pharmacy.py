@@ -1,12 +1,42 @@
 import numpy as np
-import copy
 import csv
-
-from GUI import GUI, UserParams
+import heapq
+from types import MappingProxyType
+
+from batch_store import BatchStore
+from catalog import DrugCatalog
+from demand import LogisticDemand, poisson_ppf
+from orders import OrderBatch
+from profiling import profiler
+from settlement import SaleRules, allocate_fifo, settle_orders
+from stat_sink import HistorySink
+
+# model constants: every engine (Env, BatchedEnv, FluidEnv) emulates the same pharmacy with them;
+# discounts are defaults of SaleRules
+AVERAGE_DRUGS_IN_ORDER = 3  # mean size of client order
+ORDER_VAR = 1  # standard deviation of size of client order
+CARD_PROBA = 0.3  # share of client orders with discount card
+MIN_WAITING_TIME = 1  # days of supplier delivery
+MAX_WAITING_TIME = 3
+DAYS_TO_SALE = 29  # drugs go on sale when their shelf life is shorter
+MAX_COURIER_ORDERS = 15  # orders delivered by one courier per day
+
+
+class UserParams:
+    """struct: emulation parameters from user interface"""
+    def __init__(self):
+        self.orders_scale = 0
+        self.couriers = 0
+        self.card_sale = 0
+        self.quant_to_reorder = 0
+        self.n_days = 0
 
 
 class ClientOrder:
     """structure for client order information"""
+    __slots__ = ('client_name', 'phone_number', 'address', 'drugs', 'loyal_client', 'card_id', 'ready_drugs',
+                 'total_profit', 'if_delivered')
+
     def __init__(self, meta, card_id, drugs, loyal_client=False):
         self.client_name = meta[0]
         self.phone_number = meta[2]
@@ -16,82 +46,163 @@ class ClientOrder:
         self.card_id = card_id
         self.ready_drugs = {}
         self.total_profit = 0
+        self.if_delivered = False
 
 
 class RecurringOrder:
-    """class for repeating orders"""
+    """class for repeating orders: immutable template of client order"""
     def __init__(self, meta, card_id, drugs, period):
-        self.__client_order = ClientOrder(meta, card_id, drugs, True)
+        self.__meta = tuple(meta)
+        self.__card_id = card_id
+        self.__drugs = MappingProxyType(dict(drugs))
         self.period = period
         self.last_order = None
 
+    @property
+    def client_name(self):
+        return self.__meta[0]
+
+    @property
+    def address(self):
+        return self.__meta[1]
+
+    @property
+    def phone_number(self):
+        return self.__meta[2]
+
+    @property
+    def card_id(self):
+        return self.__card_id
+
+    @property
+    def drugs(self):
+        return self.__drugs
+
+    @property
+    def loyal_client(self):
+        return True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_RecurringOrder__drugs'] = dict(self.__drugs)
+        return state
+
+    def __setstate__(self, state):
+        state['_RecurringOrder__drugs'] = MappingProxyType(state['_RecurringOrder__drugs'])
+        self.__dict__.update(state)
+
     def get_client_order(self):
-        """return copy of client order"""
-        return copy.deepcopy(self.__client_order)
+        """return new client order; ordered drugs are shared read-only with the template"""
+        return ClientOrder(self.__meta, self.__card_id, self.__drugs, True)
+
 
+class RecurringSchedule:
+    """repeating orders in min-heap by the next due day; only due orders are touched"""
+    def __init__(self, orders):
+        """
+        :param list[RecurringOrder] orders: all of them are due at the first day
+        """
+        self.__heap = [(0, i, order) for i, order in enumerate(orders)]
+        heapq.heapify(self.__heap)
 
-class DrugInfo:
-    """structure for information about drug(for pharmacy class)"""
-    def __init__(self, params):
-        self.name = params[0]
-        self.group = ""
-        self.form = ""
-        self.dose = None
-        self.standard_quantity = params[3]
-        self.base_price = params[1]
-        self.cur_price = params[1] * params[2]
-        self.base_profit = params[2]
-        self.cur_profit = params[2]
-        self.shelf_life = params[4]
+    def __len__(self):
+        return len(self.__heap)
 
+    def pop_due(self, cur_day):
+        """
+        get orders due to the day and schedule their next repetition
 
-class DrugBatch:
-    """class to check shelf-life of the drug on the store"""
-    def __init__(self, drug_name, quantity, valid_to):
-        self.drug_name = drug_name
-        self.valid_to = valid_to
-        self.quantity = quantity
+        :param int cur_day:
+        :return: List[RecurringOrder] in order of loading
+        """
+        due = []
+        while self.__heap and self.__heap[0][0] <= cur_day:
+            due.append(heapq.heappop(self.__heap))
+        due.sort(key=lambda item: item[1])
+        orders = []
+        for _, i, order in due:
+            order.last_order = cur_day
+            heapq.heappush(self.__heap, (cur_day + max(order.period, 1), i, order))
+            orders.append(order)
+        return orders
 
 
 class Randomizer:
     """class for generation random orders and"""
-    def __init__(self):
-        self.__base_prices = []
-        self.__profits = []
-        self.__average_drugs_in_order = 3
-        self.__order_var = 1
-        self.__card_proba = 0.3
+    def __init__(self, rng=None, supplier_rng=None, demand_model=None):
+        """
+        :param np.random.Generator rng: source of randomness; new unseeded generator if None
+        :param np.random.Generator supplier_rng: separate source for waiting times, so that demand
+            does not depend on how many drugs were reordered; rng is used if None
+        :param DemandModel demand_model: demand curve; LogisticDemand if None
+        """
+        self.__rng = rng if rng is not None else np.random.default_rng()
+        self.__supplier_rng = supplier_rng if supplier_rng is not None else self.__rng
+        self.__demand_model = demand_model if demand_model is not None else LogisticDemand()
+        self.__purchase_rng = None
+        self.__antithetic = False
+        # deviations of purchases from expected ones weighted by margins and by base prices:
+        # control variates with zero mean for profit and for losses
+        self.profit_residual = 0.0
+        self.cost_residual = 0.0
+        self.__base_prices = np.empty(0)
+        self.__profits = np.empty(0)
+        self.__intensity = np.empty(0)
+        self.__day = 0
         self.__max_card_id = 10000
-        self.__min_wainting_time = 1
-        self.__max_waiting_time = 3
         self.__order_scale = None
 
     def init_user_params(self, order_scale):
         """initialize parameters from user interface"""
         self.__order_scale = order_scale
 
+    def set_rng(self, rng, supplier_rng=None):
+        """replace sources of randomness (e.g. for continuation of restored emulation)"""
+        self.__rng = rng
+        self.__supplier_rng = supplier_rng if supplier_rng is not None else rng
+
+    def set_purchase_rng(self, purchase_rng, antithetic=False):
+        """
+        draw purchases by inverse CDF from uniforms of a separate source, so that a pair of runs
+        with the same source and opposite antithetic flags has negatively correlated demand
+
+        :param np.random.Generator purchase_rng: source of uniforms; purchases are drawn from rng if None
+        :param bool antithetic: use 1 - u instead of uniforms u
+        """
+        self.__purchase_rng = purchase_rng
+        self.__antithetic = antithetic
+
     def init_params(self, prices, profits):
         """initialize parameters from main"""
-        self.__profits = profits
-        self.__base_prices = prices
+        self.__profits = np.array(profits, dtype=np.float64)
+        self.__base_prices = np.asarray(prices)
+        self.__intensity = self.__demand_model.intensity(self.__base_prices, self.__profits)
 
     def update_profits(self, new_profits):
         """set pharmacy profits for drugs; use them for further generation"""
-        self.__profits = new_profits
+        new_profits = np.asarray(new_profits, dtype=np.float64)
+        changed = np.flatnonzero(new_profits != self.__profits)
+        if len(changed):
+            self.__profits[changed] = new_profits[changed]
+            self.__intensity[changed] = self.__demand_model.intensity(self.__base_prices[changed],
+                                                                      self.__profits[changed])
+
+    def expected_purchases(self):
+        """
+        average purchases of every drug for the next day
+
+        :return: np.ndarray
+        """
+        return self.__generate_purchases()
 
-    def __generate_purchases(self, x):
+    def __generate_purchases(self):
         """
-        generate purchases average num for a drug
+        generate purchases average num for all drugs; demand curve is cached and recalculated
+        only for drugs with changed markups
 
-        :param list[int,int] x: [drug price, drug markup]
-        :return: float average purchases
+        :return: np.ndarray average purchases
         """
-        price = x[0]
-        profit = x[1]
-        arg = price * (profit ** 2)
-        arg = -np.log(arg) * 2 + 12
-        res = self.__order_scale * (np.exp(arg) / (1 + np.exp(arg)))
-        return res
+        return self.__order_scale * self.__intensity * self.__demand_model.day_factor(self.__day)
 
     def start_new_day(self):
         """
@@ -99,51 +210,92 @@ class Randomizer:
 
         :return: List[((str, str, str), int, dict)] - [((name, address, phone_number), card_id, ordered_drugs)]
         """
-        average_purchases = np.apply_along_axis(self.__generate_purchases, axis=0,
-                                                arr=[self.__base_prices, self.__profits])
-        purchase_drugs = np.random.poisson(average_purchases)
-        generated_orders_info = []
-        while True:
-            meta, card_id, ordered_drugs_ids = self.__generate_order_info(purchase_drugs)
-            if ordered_drugs_ids:
-                generated_orders_info.append((meta, card_id, ordered_drugs_ids))
-            else:
-                break
-        return generated_orders_info
-
-    def __generate_order_info(self, purchase_drugs):
-        """
-        generate order parameters
-
-        :param list[int] purchase_drugs: average purchase of drugs today
-        :return: Tuple((str, str, str), int, dict) - ((name, address, phone_number), card_id, ordered_drugs)
-        """
-        meta = self.__generate_meta()
-        card_id = self.__generate_card_id()
-        ordered_drugs_ids = {}
-        n_drugs_in_order = round(np.random.normal(self.__average_drugs_in_order, self.__order_var))
-        i = 0
-        while np.sum(purchase_drugs) != 0 and i < n_drugs_in_order:
-            i += 1
-            drugs_proba = purchase_drugs / np.sum(purchase_drugs)
-            drug_id = np.random.choice(len(self.__base_prices), p=drugs_proba)
-            if drug_id in ordered_drugs_ids:
-                ordered_drugs_ids[drug_id] += 1
-            else:
-                ordered_drugs_ids[drug_id] = 1
-            purchase_drugs[drug_id] -= 1
+        batch = self.start_new_day_batch()
+        return [(meta, card_id, order.drugs) for meta, card_id, order in zip(batch.meta, batch.card_ids, batch)]
 
-        return meta, card_id, ordered_drugs_ids
+    def start_new_day_batch(self):
+        """
+        generate orders for a new day without creating objects for every order
+
+        :return: OrderBatch
+        """
+        average_purchases = self.__generate_purchases()
+        self.__day += 1
+        if self.__purchase_rng is None:
+            purchase_drugs = self.__rng.poisson(average_purchases)
+        else:
+            uniforms = self.__purchase_rng.random(len(average_purchases))
+            purchase_drugs = poisson_ppf(1 - uniforms if self.__antithetic else uniforms, average_purchases)
+        deviation = purchase_drugs - average_purchases
+        self.profit_residual += float(np.dot(deviation, self.__base_prices * (self.__profits - 1)))
+        self.cost_residual += float(np.dot(deviation, self.__base_prices))
+        return self.__generate_orders_batch(purchase_drugs)
+
+    def __generate_orders_batch(self, purchase_drugs):
+        """
+        split purchases of the day into orders
+
+        units are drawn without replacement, so a random permutation of all purchased units
+        cut into consecutive chunks of generated order sizes gives the same distribution
+        as drawing drugs one by one
 
-    def __generate_card_id(self):
+        :param np.ndarray purchase_drugs: number of purchased units for every drug today
+        :return: OrderBatch
         """
-        generate random card id or None (with given probability)
+        n_drugs = len(purchase_drugs)
+        total_units = int(np.sum(purchase_drugs))
+        if total_units == 0:
+            return OrderBatch.empty()
+
+        orders_sizes = self.__generate_orders_sizes(total_units)
+        n_orders = len(orders_sizes)
+        if n_orders == 0:
+            return OrderBatch.empty()
+
+        units = self.__rng.permutation(np.repeat(np.arange(n_drugs), purchase_drugs))
+        units = units[:int(np.sum(orders_sizes))]
+        units_orders = np.repeat(np.arange(n_orders), orders_sizes)
+        keys, counts = np.unique(units_orders * n_drugs + units, return_counts=True)
+        indptr = np.searchsorted(keys // n_drugs, np.arange(n_orders + 1))
+
+        card_ids = self.__generate_card_ids(n_orders)
+        return OrderBatch([self.__generate_meta()] * n_orders, card_ids, np.zeros(n_orders, dtype=bool),
+                          indptr, keys % n_drugs, counts)
+
+    def __generate_orders_sizes(self, total_units):
+        """
+        generate sizes of orders for the day; the last order takes the rest of units,
+        non positive size finishes the day
 
-        :return: int: card id or None
+        :param int total_units: number of purchased units today
+        :return: np.ndarray sizes of orders
         """
-        if np.random.binomial(1, self.__card_proba):
-            return np.random.randint(1, self.__max_card_id)
-        return None
+        batch = total_units // max(AVERAGE_DRUGS_IN_ORDER - ORDER_VAR, 1) + 16
+        orders_sizes = np.empty(0, dtype=np.int64)
+        while np.sum(orders_sizes) < total_units:
+            new_sizes = np.round(self.__rng.normal(AVERAGE_DRUGS_IN_ORDER, ORDER_VAR, batch))
+            orders_sizes = np.concatenate((orders_sizes, new_sizes.astype(np.int64)))
+            empty = np.flatnonzero(orders_sizes <= 0)
+            if len(empty):
+                orders_sizes = orders_sizes[:empty[0]]
+                break
+        cum_sizes = np.cumsum(orders_sizes)
+        n_orders = np.searchsorted(cum_sizes, total_units) + 1
+        orders_sizes = orders_sizes[:n_orders]
+        if len(orders_sizes) and cum_sizes[len(orders_sizes) - 1] > total_units:
+            orders_sizes[-1] -= cum_sizes[len(orders_sizes) - 1] - total_units
+        return orders_sizes
+
+    def __generate_card_ids(self, n_orders):
+        """
+        generate random card ids or None (with given probability) for several orders
+
+        :param int n_orders: number of orders
+        :return: List[int]: card ids or None
+        """
+        has_card = self.__rng.binomial(1, CARD_PROBA, n_orders).astype(bool)
+        card_ids = self.__rng.integers(1, self.__max_card_id, n_orders)
+        return [int(card_id) if card else None for card, card_id in zip(has_card, card_ids)]
 
     def __generate_meta(self):
         """
@@ -160,32 +312,83 @@ class Randomizer:
 
         :return: int: waiting time (days)
         """
-        return round(np.random.uniform(self.__min_wainting_time, self.__max_waiting_time))
+        return round(self.__supplier_rng.uniform(MIN_WAITING_TIME, MAX_WAITING_TIME))
+
+
+def load_recurring_orders(filename, catalog):
+    """
+    load info about repeating orders
+
+    :param str filename: ';' separated file: drugs(name,quantity.name,quantity);period;name;address;phone;card id
+    :param DrugCatalog catalog: drugs are given by ids from it
+    :return: List[(dict, int, str, str, str, str)] - [(drugs, period, client_name, address, phone, card_id)]
+    """
+    orders = []
+    with open(filename) as file:
+        reader = csv.reader(file, delimiter=';')
+        reader.__next__()
+        for line in reader:
+            drugs = {}
+            drugs_pos = line[0].split('.')
+            for drug in drugs_pos:
+                drug_name, drug_quant = drug.split(',')
+                drugs[catalog.id_of(drug_name)] = int(drug_quant)
+
+            period = int(line[1])
+            client_name = line[2]
+            address = line[3]
+            phone = line[4]
+            id = line[5]
+            orders.append((drugs, period, client_name, address, phone, id))
+    return orders
+
+
+def make_recurring_schedule(params_list):
+    """
+    :param list params_list: repeating orders params, see load_recurring_orders
+    :return: RecurringSchedule
+    """
+    orders = []
+    for params in params_list:
+        meta = params[2:-1]
+        card_id = params[-1]
+        period = params[1]
+        drugs = params[0]
+        orders.append(RecurringOrder(meta, card_id, drugs, period))
+    return RecurringSchedule(orders)
 
 
 class Env:
     """
     class for environment emulation
     """
-    def __init__(self, GUI, randomizer_cls, drugs_file, orders_file):
+    def __init__(self, GUI, randomizer_cls, drugs_file, orders_file, rng=None, supplier_rng=None, stat_sink=None):
         """
-        :param GUI: interface
+        :param GUI: interface or None for headless emulation
         :param randomizer_cls: randomizer class
-        :param str drugs_file: file with drugs
-        :param str orders_file:  file with repeation orders
+        :param drugs_file: file with drugs, compiled catalog directory or DrugCatalog
+        :param orders_file:  file with repeation orders or list loaded from it by load_recurring_orders
+        :param np.random.Generator rng: source of randomness for the randomizer
+        :param np.random.Generator supplier_rng: source of randomness for supplier waiting times
+        :param StatSink stat_sink: receiver of pharmacy daily statistics
         """
         self.GUI = GUI
-        self.__drugs_names = []
-        names, prices, profits, quants, life = self.__load_drugs_info(drugs_file)
-        recurring_orders = self.__load_orders_info(orders_file)
-        self.randomizer = randomizer_cls()
-        self.randomizer.init_params(prices, profits)
-        self.pharmacy = Pharmacy(names, prices, profits, quants, life, recurring_orders)
+        self.catalog = drugs_file if isinstance(drugs_file, DrugCatalog) else DrugCatalog.open(drugs_file)
+        recurring_orders = orders_file if isinstance(orders_file, list) else self.__load_orders_info(orders_file)
+        self.randomizer = randomizer_cls(rng=rng, supplier_rng=supplier_rng)
+        self.randomizer.init_params(self.catalog.prices, self.catalog.profits)
+        self.pharmacy = Pharmacy(self.catalog, recurring_orders, stat_sink)
 
         self.cur_day = 0
         self.n_days = None
         self.order_history = []
-        self.pharmacy_orders_queue = []
+        self.pharmacy_orders_queue = Supplier(self.randomizer.generate_waiting_time)
+
+    def __getstate__(self):
+        """interface is not a part of emulation state"""
+        state = self.__dict__.copy()
+        state['GUI'] = None
+        return state
 
     def init_user_parameters(self, params):
         """
@@ -201,106 +404,87 @@ class Env:
         self.randomizer.init_user_params(orders_scale)
         self.pharmacy.init_user_params(couriers, card_sale, quant_to_reorder)
 
-    def __load_drugs_info(self, filename):
-        """
-        open and parse file with drug information
-        :param str filename:
-        :return: Tuple:(List[names], List[prices], List[profits], List[quants], List[lifes])
-        """
-        names = []
-        prices = []
-        profits = []
-        quants = []
-        life = []
-        with open(filename) as file:
-            reader = csv.reader(file, delimiter=';')
-            reader.__next__()
-            for line in reader:
-                name = line[0]
-                names.append(name)
-                prices.append(int(line[1]))
-                profits.append(float(line[2]))
-                quants.append(int(line[3]))
-                life.append(int(line[4]))
-
-                self.__drugs_names.append(name)
-        return names, prices, profits, quants, life
-
     def __load_orders_info(self, filename):
-        """load info about repeating orders"""
-        orders = []
-        with open(filename) as file:
-            reader = csv.reader(file, delimiter=';')
-            reader.__next__()
-            for line in reader:
-                drugs = {}
-                drugs_pos = line[0].split('.')
-                for drug in drugs_pos:
-                    drug_name, drug_quant = drug.split(',')
-                    drugs[drug_name] = int(drug_quant)
-
-                period = int(line[1])
-                client_name = line[2]
-                address = line[3]
-                phone = line[4]
-                id = line[5]
-                orders.append((drugs, period, client_name, address, phone, id))
-        return orders
+        """load info about repeating orders; drugs are given by ids from catalog"""
+        return load_recurring_orders(filename, self.catalog)
 
     def __generate_client_orders(self):
         """for new day generate list of client orders"""
-        orders_list = []
-        generated_info_list = self.randomizer.start_new_day()
-        for meta, card_id, drugs_ids in generated_info_list:
-            drugs = {}
-            for drug_id, drug_num in drugs_ids.items():
-                drugs[self.__drugs_names[drug_id]] = drug_num
-            orders_list.append(ClientOrder(meta, card_id, drugs))
-        return orders_list
+        return self.randomizer.start_new_day_batch()
 
     def __daily_routine(self):
         """do usual daily generations and interact with pharmacy"""
-        delivered_drugs = []
-        while self.pharmacy_orders_queue != [] and self.pharmacy_orders_queue[0][0] == self.cur_day:
-            delivered_order = self.pharmacy_orders_queue.pop(0)[1]
-            delivered_drugs.append(delivered_order.drug)
-        self.pharmacy.deliver_drugs(delivered_drugs)
-
-        orders = self.__generate_client_orders()
-        self.pharmacy.new_day(orders)
-
-        pharmacy_orders = self.pharmacy.get_drugs_orders()
-        for order in pharmacy_orders:
-            delivery_date = self.cur_day + self.randomizer.generate_waiting_time()
-            self.pharmacy_orders_queue.append((delivery_date, order))
-        self.pharmacy_orders_queue = sorted(self.pharmacy_orders_queue, key=lambda x: x[0])
-
-        profits = self.pharmacy.get_profits()
-        self.randomizer.update_profits(profits)
-
-        stats = self.pharmacy.get_statistic()
+        with profiler.phase('day'):
+            with profiler.phase('supplier.deliver'):
+                delivered_drugs = [order.drug for order in self.pharmacy_orders_queue.pop_due(self.cur_day)]
+                self.pharmacy.deliver_drugs(delivered_drugs)
+            profiler.count('delivered_batches', len(delivered_drugs))
+
+            with profiler.phase('demand'):
+                orders = self.__generate_client_orders()
+            self.pharmacy.new_day(orders)
+
+            with profiler.phase('supplier.order'):
+                pharmacy_orders = self.pharmacy.get_drugs_orders()
+                for order in pharmacy_orders:
+                    self.pharmacy_orders_queue.order(self.cur_day, order)
+            profiler.count('reorders', len(pharmacy_orders))
+
+            with profiler.phase('demand.update_profits'):
+                profits = self.pharmacy.get_profits()
+                self.randomizer.update_profits(profits)
+
+            stats = self.pharmacy.get_statistic()
+        profiler.end_day(self.cur_day)
         return stats
 
     def start_next_day(self, no_tmp=False):
         """
         start emulation day by day
         :param bool no_tmp: flag - don't temporary statistic after each day
+        :return: FinalStat after the last day or None
         """
         if not no_tmp:
             if self.cur_day < self.n_days:
                 stats = self.__daily_routine()
-                self.GUI.show_tmp_statistic(stats)
+                if self.GUI is not None:
+                    self.GUI.show_tmp_statistic(stats)
                 self.cur_day += 1
             else:
-                final_stats = self.pharmacy.get_final_stats()
-                self.GUI.show_final_statistic(final_stats)
+                final_stats = self.__get_final_stats()
+                if self.GUI is not None:
+                    self.GUI.show_final_statistic(final_stats)
+                return final_stats
         else:
-            for _ in range(self.n_days):
-                _ = self.__daily_routine()
-                self.cur_day += 1
-            final_stats = self.pharmacy.get_final_stats()
-            print(final_stats)
-            self.GUI.show_final_statistic(final_stats)
+            final_stats = self.run_to_end()
+            if self.GUI is not None:
+                self.GUI.show_final_statistic(final_stats)
+            return final_stats
+        return None
+
+    def run_to_end(self, progress=None, cancel=None):
+        """
+        emulate remaining days without interface calls, so it can run in a worker thread
+
+        :param progress: function (cur_day, n_days, total_profit) called after each day
+        :param threading.Event cancel: emulation stops after the current day when it is set
+        :return: FinalStat or None if cancelled
+        """
+        while self.cur_day < self.n_days:
+            if cancel is not None and cancel.is_set():
+                return None
+            self.__daily_routine()
+            self.cur_day += 1
+            if progress is not None:
+                progress(self.cur_day, self.n_days, self.pharmacy.get_total_profit())
+        return self.__get_final_stats()
+
+    def __get_final_stats(self):
+        """final statistics of pharmacy with emulation part of it"""
+        final_stats = self.pharmacy.get_final_stats()
+        final_stats.profit_residual = self.randomizer.profit_residual
+        final_stats.cost_residual = self.randomizer.cost_residual
+        return final_stats
 
 
 class PharmacyOrder:
@@ -309,14 +493,89 @@ class PharmacyOrder:
         self.drug = drug
 
 
+class Supplier:
+    """
+    supplier of drugs for pharmacy: priority queue of pharmacy orders keyed by delivery day;
+    orders with the same delivery day come in order of placing
+    """
+    def __init__(self, waiting_time_fn):
+        """
+        :param waiting_time_fn: function without arguments returning waiting time (days) for new order
+        """
+        self.__waiting_time_fn = waiting_time_fn
+        self.__queue = []
+        self.__n_placed = 0
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def order(self, cur_day, order):
+        """
+        place order with random waiting time
+
+        :param int cur_day: day of placing
+        :param PharmacyOrder order:
+        :return: int delivery day
+        """
+        delivery_day = cur_day + self.__waiting_time_fn()
+        self.push(delivery_day, order)
+        return delivery_day
+
+    def push(self, delivery_day, order):
+        """place order with known delivery day"""
+        heapq.heappush(self.__queue, (delivery_day, self.__n_placed, order))
+        self.__n_placed += 1
+
+    def next_delivery_day(self):
+        """:return: int day of the nearest delivery or None"""
+        return self.__queue[0][0] if self.__queue else None
+
+    def pop_due(self, cur_day):
+        """
+        take orders delivered to the given day
+
+        :param int cur_day:
+        :return: List[PharmacyOrder]
+        """
+        due = []
+        while self.__queue and self.__queue[0][0] <= cur_day:
+            due.append(heapq.heappop(self.__queue)[2])
+        return due
+
+
 class DailyStat:
     """struct: daily statistics from pharmacy to GUI"""
     def __init__(self):
         self.cur_day = 0
-        self.drugs_at_store = {}
         self.courier_max_load = 0
+        self.today_ordered = 0
         self.today_delivered = 0
         self.delivered_orders = []
+        self.drug_names = []
+        self.prices = None
+        self.drugs_ordered = None
+        self.drugs_at_store = None
+        # ids of drugs whose price, ordered quantity or stock differ from the previous day; None - all drugs
+        self.changed_ids = None
+
+    @property
+    def drugs_info(self):
+        """dict(drug_name;[price, ordered today, quantity on store]) - built only when asked"""
+        return {name: [price, ordered, quant] for name, price, ordered, quant
+                in zip(self.drug_names, self.prices.tolist(), self.drugs_ordered.tolist(),
+                       self.drugs_at_store.tolist())}
+
+    def rows(self, drug_ids):
+        """
+        rows of drugs table for the given drugs only
+
+        :param drug_ids: iterable of drug ids (e.g. changed_ids or range of visible rows)
+        :return: List[(str, float, int, int)] - (drug_name, price, ordered today, quantity on store)
+        """
+        drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        return [(self.drug_names[drug_id], price, ordered, quant) for drug_id, price, ordered, quant
+                in zip(drug_ids.tolist(), self.prices[drug_ids].tolist(), self.drugs_ordered[drug_ids].tolist(),
+                       self.drugs_at_store[drug_ids].tolist())]
 
 
 class FinalStat:
@@ -326,33 +585,51 @@ class FinalStat:
         self.total_lost = 0
         self.courier_max_load = 0
         self.delivered_history = []
+        # filled by statistics sink
+        self.days = 0
+        self.courier_load_mean = None
+        self.courier_load_std = None
+        self.courier_load_max = None
+        self.courier_load_quantiles = {}
+        self.total_delivered = None
+        self.log_path = None
+        # filled by emulation: deviations of demand from expectation (see Randomizer)
+        self.profit_residual = None
+        self.cost_residual = None
 
 
 class Pharmacy:
     """class emulating pharmacy"""
-    def __init__(self, names, base_prices, profits, quant, lifes, recurring_params):
-        self.__drug_info_list = {}
-        for drug_info in zip(names, base_prices, profits, quant, lifes):
-            self.__drug_info_list[drug_info[0]] = DrugInfo(drug_info)
-
-        self.__drug_store = {}  # dict(drug_name;DrugBatchList)
-        self.__waiting_to_store = []
+    def __init__(self, catalog, recurring_params, stat_sink=None):
+        """
+        :param DrugCatalog catalog: drugs of pharmacy
+        :param list recurring_params: repeating orders params (drugs are given by ids)
+        :param StatSink stat_sink: receiver of daily statistics; HistorySink if None
+        """
+        self.__catalog = catalog
+        self.__n_drugs = len(catalog)
+        self.__base_prices = catalog.prices
+        self.__base_profits = catalog.profits
+        self.__full_prices = self.__base_prices * self.__base_profits
+        self.__cur_prices = self.__full_prices.copy()
+        self.__cur_profits = self.__base_profits.copy()
+
+        self.__drug_store = BatchStore(self.__n_drugs)
+        self.__expiry_calendar = {}  # dict(day;List[drug_id]) - drugs with batches to write off at the day
+        self.__sale_calendar = {}  # dict(day;List[drug_id]) - drugs which batches come close to expiry
+        self.__changed_drugs = set()  # drug ids to check at the end of the day
+        self.__waiting_to_store = np.zeros(self.__n_drugs, dtype=bool)
         self.__cur_day = 0
         self.__init_store()
 
-        self.__big_order_thre = 1000
-        self.__big_order_sale = 0.03
-        self.__loyal_sale = 0.05
-        self.__card_sale = None
-        self.__max_sale = 0.09
+        self.__sale_rules = SaleRules(card_sale=None)
 
         self.__couriers = None
-        self.__max_courier_orders = 15
         self.__courier_max_load = None
-        self.__to_deliver_history = []
+        self.__stat_sink = stat_sink if stat_sink is not None else HistorySink()
 
         self.__min_quant_to_reorder = None
-        self.__recurring_orders = []
+        self.__recurring_orders = None
         self.__init_recurring_orders(recurring_params)
 
         self.__orders_from_pharmacy = None
@@ -363,69 +640,89 @@ class Pharmacy:
     def init_user_params(self, couriers, card_sale, quant_to_reorder):
         """init parameters from GUI"""
         self.__couriers = couriers
-        self.__card_sale = card_sale
+        self.__sale_rules.card_sale = card_sale
         self.__min_quant_to_reorder = quant_to_reorder
-        self.__courier_max_load = self.__couriers * self.__max_courier_orders
+        self.__courier_max_load = self.__couriers * MAX_COURIER_ORDERS
 
     def __init_store(self):
         """initialize store and prepare for emulation run"""
-        for drug_info in self.__drug_info_list.items():
-            name = drug_info[0]
-            quant = drug_info[1].standard_quantity
-            valid_to = self.__cur_day+drug_info[1].shelf_life
-            self.__drug_store[name] = [DrugBatch(name, quant, valid_to)]
+        self.__add_batches(np.arange(self.__n_drugs))
+
+    def __add_batches(self, drug_ids):
+        """put standard batches of drugs on store and register them in expiry and sale calendars"""
+        drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        valid_to = self.__cur_day + self.__catalog.shelf_lives[drug_ids]
+        self.__drug_store.push(drug_ids, self.__catalog.quantities[drug_ids], valid_to)
+        for drug_id, day in zip(drug_ids.tolist(), valid_to.tolist()):
+            self.__expiry_calendar.setdefault(day + 1, []).append(drug_id)
+            self.__sale_calendar.setdefault(day - DAYS_TO_SALE, []).append(drug_id)
+        self.__changed_drugs.update(drug_ids.tolist())
 
     def __init_recurring_orders(self, params_list):
-        """initialize repeating orders and """
-        for params in params_list:
-            meta = params[2:-1]
-            card_id = params[-1]
-            period = params[1]
-            drugs = params[0]
-            self.__recurring_orders.append(RecurringOrder(meta, card_id, drugs, period))
+        """initialize repeating orders and their schedule"""
+        self.__recurring_orders = make_recurring_schedule(params_list)
+
+    def get_total_profit(self):
+        """:return: float profit from the first day"""
+        return self.__total_profit
 
     def get_profits(self):
         """return updated markups"""
-        prof = []
-        for drug_info in self.__drug_info_list.values():
-            prof.append(drug_info.cur_profit)
-        return prof
+        return self.__cur_profits.copy()
 
     def new_day(self, client_orders):
-        """start new day for pharmacy; do standard actions"""
+        """
+        start new day for pharmacy; do standard actions
+
+        :param client_orders: OrderBatch or list of ClientOrder (settlement results go to the batch)
+        """
+        if not isinstance(client_orders, OrderBatch):
+            client_orders = OrderBatch.from_orders(client_orders)
+        previous = self.__stats
         self.__stats = DailyStat()
         self.__stats.courier_max_load = self.__courier_max_load
-        queue = client_orders[:]
-        today_delivered = 0
         self.__cur_day += 1
 
-        queue += self.__proc_recurring_orders()
-
-        orders_to_deliver, drugs_ordered = self.__process_orders(queue)
-        while today_delivered < len(orders_to_deliver) and today_delivered < self.__courier_max_load:
-            orders_to_deliver[today_delivered].if_delivered = True
-            self.__total_profit += orders_to_deliver[today_delivered].total_profit
-            today_delivered += 1
+        with profiler.phase('recurring_orders'):
+            batch = OrderBatch.concat([client_orders, self.__proc_recurring_orders()])
+        profiler.count('orders', len(batch))
+
+        with profiler.phase('settlement'):
+            ready_orders, drugs_ordered = self.__process_orders(batch)
+        if profiler.enabled:
+            profiler.count('units', int(batch.quantity.sum()))
+        today_delivered = min(len(ready_orders), self.__courier_max_load)
+        delivered = ready_orders[:today_delivered]
+        batch.delivered[delivered] = True
+        profit_before = self.__total_profit
+        for profit in batch.total_profit[delivered].tolist():
+            self.__total_profit += profit
 
-        self.__to_deliver_history.append(len(orders_to_deliver))
         self.__stats.cur_day = self.__cur_day
-        self.__stats.today_ordered = len(orders_to_deliver)
+        self.__stats.today_ordered = len(ready_orders)
         self.__stats.today_delivered = today_delivered
-        self.__stats.delivered_orders = orders_to_deliver[:today_delivered]
-        orders_form_pharmacy, add_sale, remove_sale, stats_from_store = self.__check_store()
+        self.__stats.delivered_orders = batch.select(delivered)
+        lost_before = self.__lost_shelf_life
+        with profiler.phase('check_store'):
+            orders_form_pharmacy, add_sale, remove_sale = self.__check_store()
         self.__orders_from_pharmacy = orders_form_pharmacy
-        new_prices = self.__update_prices(add_sale, remove_sale)
-        self.__stats.drugs_info = {item[0]: [item[1], drugs_ordered[item[0]], stats_from_store[item[0]]]
-                                   for item in new_prices.items()}
+        with profiler.phase('update_prices'):
+            self.__update_prices(add_sale, remove_sale)
+        # names are resolved only in DailyStat.drugs_info - for user interface
+        self.__stats.drug_names = self.__catalog.names
+        self.__stats.prices = self.__cur_prices.copy()
+        self.__stats.drugs_ordered = drugs_ordered
+        self.__stats.drugs_at_store = self.__drug_store.totals.copy()
+        if previous is not None:
+            self.__stats.changed_ids = np.flatnonzero((self.__stats.prices != previous.prices)
+                                                      | (drugs_ordered != previous.drugs_ordered)
+                                                      | (self.__stats.drugs_at_store != previous.drugs_at_store))
+        self.__stat_sink.add_day(self.__cur_day, len(ready_orders), today_delivered, self.__courier_max_load,
+                                 self.__total_profit - profit_before, self.__lost_shelf_life - lost_before)
 
     def __proc_recurring_orders(self):
         """get orders from loyal clients"""
-        orders = []
-        for order in self.__recurring_orders:
-            if order.last_order is None or self.__cur_day - order.last_order >= order.period:
-                order.last_order = self.__cur_day
-                orders.append(order.get_client_order())
-        return orders
+        return OrderBatch.from_orders(self.__recurring_orders.pop_due(self.__cur_day), loyal=True)
 
     def get_drugs_orders(self):
         """get orders from pharmacy (to deliver more drugs)"""
@@ -433,117 +730,136 @@ class Pharmacy:
         self.__orders_from_pharmacy = None
         return ret
 
-    def deliver_drugs(self, drug_names):
+    def deliver_drugs(self, drug_ids):
         """deliver ordered drugs on pharmacy store"""
-        for drug in drug_names:
-            shelf_life = self.__drug_info_list[drug].shelf_life
-            standard_quantity = self.__drug_info_list[drug].standard_quantity
-            new_batch = DrugBatch(drug, standard_quantity, shelf_life+self.__cur_day)
-            self.__drug_store[drug].append(new_batch)
-            self.__waiting_to_store.remove(drug)
+        self.__add_batches(drug_ids)
+        self.__waiting_to_store[drug_ids] = False
+
+    def surplus(self, drug_ids, keep):
+        """
+        quantity of drugs which can be given to other pharmacy: stock above reorder threshold and keep,
+        but not more than units of batches which are not close to expiry (see send_transfer)
+
+        :param np.ndarray drug_ids:
+        :param keep: quantity to keep above reorder threshold (int or np.ndarray for every drug)
+        :return: np.ndarray
+        """
+        drug_ids = np.asarray(drug_ids, dtype=np.int64)
+        rest = self.__drug_store.totals[drug_ids] - self.__min_quant_to_reorder - keep
+        fresh = self.__drug_store.units_valid_from(drug_ids, self.__cur_day + DAYS_TO_SALE + 1)
+        return np.maximum(np.minimum(rest, fresh), 0)
+
+    def send_transfer(self, drug_id, quantity):
+        """
+        take drugs from store for other pharmacy, old drugs go first; batches close to expiry
+        (which are or soon will be on sale here) are not given away
+
+        :param int drug_id:
+        :param int quantity:
+        :return: List[(int, int)] - taken batches (quantity, valid_to)
+        """
+        batches = self.__drug_store.take_batches(drug_id, quantity, self.__cur_day + DAYS_TO_SALE + 1)
+        if batches:
+            self.__changed_drugs.add(drug_id)
+        return batches
+
+    def receive_transfer(self, drug_id, batches):
+        """
+        put drugs from other pharmacy on store; the transfer fills the pending reorder of the drug
+        (its supplier order is not placed)
+
+        :param int drug_id:
+        :param list[(int, int)] batches: (quantity, valid_to)
+        """
+        for quantity, valid_to in batches:
+            self.__drug_store.insert(drug_id, quantity, valid_to)
+            # a batch which is already overdue is written off at the next check
+            self.__expiry_calendar.setdefault(max(valid_to + 1, self.__cur_day + 1), []).append(drug_id)
+            self.__sale_calendar.setdefault(valid_to - DAYS_TO_SALE, []).append(drug_id)
+        if batches:
+            self.__waiting_to_store[drug_id] = False
+            self.__changed_drugs.add(drug_id)
 
     def get_statistic(self):
         """get daily statistic"""
         return self.__stats
 
     def get_final_stats(self):
+        """get final statistics; daily part of it comes from statistics sink"""
         stat = FinalStat()
-        stat.delivered_history = self.__to_deliver_history
         stat.courier_max_load = self.__courier_max_load
         stat.total_profit = self.__total_profit
         stat.total_lost = self.__lost_shelf_life
+        self.__stat_sink.fill_final(stat)
         return stat
 
     def __update_prices(self, decrease_drugs, increase_drugs):
         """update prices for drugs after this day"""
         # decrease prices
-        for drug in decrease_drugs:
-            drug_info = self.__drug_info_list[drug]
-            drug_info.cur_price = (drug_info.base_price * drug_info.base_profit) / 2
-            drug_info.cur_profit = drug_info.cur_price / drug_info.base_price
+        self.__cur_prices[decrease_drugs] = self.__full_prices[decrease_drugs] / 2
+        self.__cur_profits[decrease_drugs] = self.__cur_prices[decrease_drugs] / self.__base_prices[decrease_drugs]
         # increase prices
-        for drug in increase_drugs:
-            drug_info = self.__drug_info_list[drug]
-            drug_info.cur_price = drug_info.base_price * drug_info.base_profit
-            drug_info.cur_profit = drug_info.base_profit
-        return {item[0]: item[1].cur_price for item in self.__drug_info_list.items()}
-
-    def __process_orders(self, orders):
-        ready_orders = []
-        drugs_ordered = {drug_name: 0 for drug_name in self.__drug_info_list.keys()}
-        for order in orders:
-            order_base_income = 0
-            order_cur_income = 0
-            order_sale = 0.0
-            for drug in order.drugs.items():
-                drug_name = drug[0]
-                drugs_ordered[drug_name] += drug[1]
-                avail_num = self.__get_drug_from_store(drug_name, drug[1])
-                if avail_num > 0:
-                    base_price = self.__drug_info_list[drug_name].base_price
-                    cur_price = self.__drug_info_list[drug_name].cur_price
-                    order_base_income += avail_num * base_price
-                    order_cur_income += avail_num * cur_price
-
-                    order.ready_drugs[drug_name] = avail_num
-
-            if order.card_id:
-                order_sale += self.__card_sale
-            elif order_cur_income > self.__big_order_thre:
-                order_sale += self.__big_order_sale
-            if order.loyal_client:
-                order_sale = min(self.__max_sale, order_sale+self.__loyal_sale)
-
-            order_cur_income -= order_cur_income * order_sale
-            order.total_profit = (order_cur_income - order_base_income)
-
-            if order_cur_income != 0:
-                ready_orders.append(order)
-        return ready_orders, drugs_ordered
+        self.__cur_prices[increase_drugs] = self.__full_prices[increase_drugs]
+        self.__cur_profits[increase_drugs] = self.__base_profits[increase_drugs]
+
+    def __process_orders(self, batch):
+        """
+        settle all orders of the day at once
+
+        orders are a sparse order x drug matrix (lines); drugs are given to lines in order of orders
+        (so early orders can exhaust stock for later ones), incomes and discounts are calculated
+        with array operations; ready quantities and profits are written to the batch
+
+        :param OrderBatch batch:
+        :return: Tuple(np.ndarray, np.ndarray) - indices of ready orders and ordered quantity of every drug
+        """
+        lines_order = batch.lines_order()
+        drugs_ordered = np.bincount(batch.drug_ids, weights=batch.quantity,
+                                    minlength=self.__n_drugs).astype(np.int64)
+
+        batch.ready = allocate_fifo(batch.drug_ids, batch.quantity, self.__drug_store.totals)
+        ordered_ids = np.flatnonzero(drugs_ordered)
+        taken = self.__drug_store.take_many(ordered_ids, drugs_ordered[ordered_ids])
+        self.__changed_drugs.update(ordered_ids[taken > 0].tolist())
+
+        cur_income, batch.total_profit = settle_orders(lines_order, batch.drug_ids, batch.ready, len(batch),
+                                                       self.__base_prices, self.__cur_prices, batch.has_card,
+                                                       batch.loyal, self.__sale_rules)
+        return np.flatnonzero(cur_income != 0), drugs_ordered
 
     def __check_store(self):
-        """check store for overdue and running/ran out drugs"""
-        add_sale_names = []
-        remove_sale_names = []
-        pharmacy_orders = []
-        drugs_quant = {}
-
-        for drug_on_store in self.__drug_store.items():
-            drug_name = drug_on_store[0]
-            drug_batches = drug_on_store[1]
-            base_price = self.__drug_info_list[drug_name].base_price
-            # today was the last day
-            while drug_batches and drug_batches[0].valid_to == self.__cur_day-1:
-                self.__lost_shelf_life += drug_batches[0].quantity * base_price
-                drug_batches.pop(0)
-            if drug_batches and drug_batches[0].valid_to - self.__cur_day <= 29:
-                drug_info = self.__drug_info_list[drug_name]
-                if drug_info.cur_price == drug_info.base_price * drug_info.base_profit:
-                    add_sale_names.append(drug_name)
-            if drug_batches == [] or drug_batches[0].valid_to - self.__cur_day > 29:
-                drug_info = self.__drug_info_list[drug_name]
-                if drug_info.cur_price < drug_info.base_price * drug_info.base_profit:
-                    remove_sale_names.append(drug_name)
-            drug_sum = 0
-            for drug_batch in drug_batches:
-                drug_sum += drug_batch.quantity
-            if drug_name not in self.__waiting_to_store and drug_sum <= self.__min_quant_to_reorder:
-                pharmacy_orders.append(PharmacyOrder(drug_name))
-                self.__waiting_to_store.append(drug_name)
-            drugs_quant[drug_name] = drug_sum
-
-        return pharmacy_orders, add_sale_names, remove_sale_names, drugs_quant
-
-    def __get_drug_from_store(self, name, needed):
-        """get needed drugs from store(if possible) old drugs goes first"""
-        total = 0
-        drug_batch_list = self.__drug_store[name]
-        while drug_batch_list and total < needed:
-            cur_batch = drug_batch_list[0]
-            from_cur_batch = min(needed-total, cur_batch.quantity)
-            if from_cur_batch == cur_batch.quantity:
-                drug_batch_list.pop(0)
-            else:
-                cur_batch.quantity -= from_cur_batch
-            total += from_cur_batch
-        return total
+        """
+        check store for overdue and running/ran out drugs
+
+        only drugs changed since the last check (taken, delivered, written off or come close
+        to expiry) are checked - others can't change their state
+        """
+        # today was the last day
+        if self.__cur_day in self.__expiry_calendar:
+            to_check = np.unique(self.__expiry_calendar.pop(self.__cur_day))
+            if profiler.enabled:
+                batches_before = int(self.__drug_store.count[to_check].sum())
+            expired_ids, expired_quants = self.__drug_store.expire(self.__cur_day, to_check)
+            self.__lost_shelf_life += np.sum(expired_quants * self.__base_prices[expired_ids]).item()
+            if profiler.enabled:
+                profiler.count('expired_batches', batches_before - int(self.__drug_store.count[to_check].sum()))
+            self.__changed_drugs.update(expired_ids.tolist())
+        for day in [day for day in self.__sale_calendar if day <= self.__cur_day]:
+            self.__changed_drugs.update(self.__sale_calendar.pop(day))
+
+        changed_ids = np.array(sorted(self.__changed_drugs), dtype=np.int64)
+        self.__changed_drugs.clear()
+        # no batches - valid_to is BatchStore.NO_BATCH
+        close_to_expiry = self.__drug_store.first_valid_to(changed_ids) - self.__cur_day <= DAYS_TO_SALE
+        cur_prices = self.__cur_prices[changed_ids]
+        full_prices = self.__full_prices[changed_ids]
+        add_sale_ids = changed_ids[close_to_expiry & (cur_prices == full_prices)]
+        remove_sale_ids = changed_ids[~close_to_expiry & (cur_prices < full_prices)]
+
+        to_reorder = ~self.__waiting_to_store[changed_ids] & \
+            (self.__drug_store.totals[changed_ids] <= self.__min_quant_to_reorder)
+        reorder_ids = changed_ids[to_reorder]
+        self.__waiting_to_store[reorder_ids] = True
+        pharmacy_orders = [PharmacyOrder(drug_id) for drug_id in reorder_ids.tolist()]
+
+        return pharmacy_orders, add_sale_ids, remove_sale_ids
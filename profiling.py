@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+
+PROFILE_ENV = 'PHARMACY_PROFILE'
+
+
+class Profiler:
+    """
+    named phase timers and per-day counters of emulation; when disabled phase() returns
+    a shared empty context and count() returns at once, so instrumented code costs one call
+
+    enable it with enable() or with PHARMACY_PROFILE=1 environment variable
+    """
+    def __init__(self, enabled=False, clock=time.perf_counter):
+        """
+        :param bool enabled:
+        :param clock: function returning seconds
+        """
+        self.enabled = enabled
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        """forget all measurements"""
+        self.start = self.clock()
+        # phase name -> [calls, total seconds, max seconds]
+        self.phases = {}
+        # counter name -> total
+        self.counters = {}
+        # [(day, {counter name: value})]
+        self.days = []
+        self.__day_counts = {}
+        # (name, start, duration, thread id) for trace
+        self.events = []
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def phase(self, name):
+        """
+        :param str name: name of timed part of code, nested phases are allowed
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def count(self, name, value=1):
+        """
+        :param str name: name of counter
+        :param int value: added to counter of the current day
+        """
+        if not self.enabled:
+            return
+        self.__day_counts[name] = self.__day_counts.get(name, 0) + value
+
+    def end_day(self, day):
+        """close counters of the day"""
+        if not self.enabled:
+            return
+        for name, value in self.__day_counts.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.days.append((day, self.__day_counts))
+        self.__day_counts = {}
+
+    def add_phase(self, name, start, duration):
+        stat = self.phases.get(name)
+        if stat is None:
+            stat = self.phases[name] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += duration
+        stat[2] = max(stat[2], duration)
+        self.events.append((name, start, duration, threading.get_ident()))
+
+    def summary(self):
+        """
+        :return: dict phase name -> dict(calls, total, mean, max) in seconds and dict of counters totals
+        """
+        phases = {name: {'calls': calls, 'total': total, 'mean': total / calls, 'max': longest}
+                  for name, (calls, total, longest) in self.phases.items()}
+        return {'phases': phases, 'counters': dict(self.counters), 'days': len(self.days)}
+
+    def format_summary(self):
+        """:return: str table of phases sorted by total time and counters per day"""
+        summary = self.summary()
+        lines = ['{:<28}{:>10}{:>12}{:>12}{:>12}'.format('phase', 'calls', 'total, s', 'mean, ms', 'max, ms')]
+        for name, stat in sorted(summary['phases'].items(), key=lambda item: -item[1]['total']):
+            lines.append('{:<28}{:>10}{:>12.4f}{:>12.4f}{:>12.4f}'.format(
+                name, stat['calls'], stat['total'], stat['mean'] * 1000, stat['max'] * 1000))
+        n_days = max(summary['days'], 1)
+        for name, total in sorted(summary['counters'].items()):
+            lines.append('{:<28}{:>10} total {:>12.2f} per day'.format(name, total, total / n_days))
+        return '\n'.join(lines)
+
+    def trace(self):
+        """:return: dict in Chrome trace event format (chrome://tracing, Perfetto)"""
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': (start - self.start) * 1e6, 'dur': duration * 1e6}
+                  for name, start, duration, tid in self.events]
+        day_ends = sorted(start + duration for name, start, duration, _ in self.events if name == 'day')
+        for i, (day, counts) in enumerate(self.days):
+            ts = (day_ends[i] - self.start) * 1e6 if i < len(day_ends) else 0
+            events.append({'name': 'day counters', 'ph': 'C', 'pid': pid, 'ts': ts, 'args': counts})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_trace(self, path):
+        """
+        :param str path: json file for chrome://tracing
+        """
+        with open(path, 'w') as file:
+            json.dump(self.trace(), file)
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.profiler.clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_phase(self.name, self.start, self.profiler.clock() - self.start)
+        return False
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+# the profiler of emulation code
+profiler = Profiler(enabled=os.environ.get(PROFILE_ENV, '') not in ('', '0'))
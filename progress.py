@@ -0,0 +1,64 @@
+import time
+
+
+class Progress:
+    """struct: state of long emulation for interface"""
+    def __init__(self, cur_day, n_days, total_profit, elapsed):
+        """
+        :param int cur_day: number of emulated days
+        :param int n_days: emulation period
+        :param float total_profit: profit from the first day
+        :param float elapsed: seconds from the start
+        """
+        self.cur_day = cur_day
+        self.n_days = n_days
+        self.total_profit = total_profit
+        self.elapsed = elapsed
+
+    @property
+    def fraction(self):
+        return self.cur_day / self.n_days if self.n_days else 1.0
+
+    @property
+    def eta(self):
+        """seconds to the end estimated by mean speed; None before the first day"""
+        if not self.cur_day:
+            return None
+        return self.elapsed / self.cur_day * (self.n_days - self.cur_day)
+
+
+class ProgressThrottle:
+    """
+    progress callback for Env.run_to_end which passes Progress to the consumer
+    not more often than once per interval (and always after the last day)
+    """
+    def __init__(self, consumer, interval=0.2, clock=time.monotonic):
+        """
+        :param consumer: function (Progress) - e.g. one scheduling interface update
+        :param float interval: min seconds between calls
+        :param clock: function returning seconds
+        """
+        self.consumer = consumer
+        self.interval = interval
+        self.clock = clock
+        self.start = clock()
+        self.__last = None
+
+    def __call__(self, cur_day, n_days, total_profit):
+        now = self.clock()
+        if cur_day < n_days and self.__last is not None and now - self.__last < self.interval:
+            return
+        self.__last = now
+        self.consumer(Progress(cur_day, n_days, total_profit, now - self.start))
+
+
+def format_eta(seconds):
+    """
+    :param float seconds: or None
+    :return: str like 1:05:09
+    """
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds) if hours else '{}:{:02d}'.format(minutes, seconds)
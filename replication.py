@@ -0,0 +1,270 @@
+import math
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+
+from batched import BatchedEnv
+from result_cache import cached_run, run_key
+from simulation import Simulation, build_arg_parser, child_seeds, courier_load, make_user_params
+
+# FinalStat field of control variate for metric
+CONTROLS = {'total_profit': 'profit_residual', 'total_lost': 'cost_residual'}
+
+
+class MetricSummary:
+    """struct: mean and confidence interval of one metric over replications"""
+    def __init__(self, values, confidence=0.95):
+        """
+        :param list[float] values: metric value for every replication
+        :param float confidence: confidence level of the interval
+        """
+        self.n = len(values)
+        self.mean = statistics.fmean(values) if values else 0.0
+        self.std = statistics.stdev(values) if self.n > 1 else 0.0
+        self.half_width = half_width(self.std, self.n, confidence)
+        self.ci_low = self.mean - self.half_width
+        self.ci_high = self.mean + self.half_width
+
+    def __repr__(self):
+        return '{:.2f} +- {:.2f} (n={})'.format(self.mean, self.half_width, self.n)
+
+
+class ReplicationStat:
+    """struct: aggregated final statistics of independent runs"""
+    def __init__(self, final_stats, confidence=0.95):
+        """
+        :param list[FinalStat] final_stats: statistics of every run
+        :param float confidence: confidence level of the intervals
+        """
+        self.final_stats = final_stats
+        self.total_profit = MetricSummary([s.total_profit for s in final_stats], confidence)
+        self.total_lost = MetricSummary([s.total_lost for s in final_stats], confidence)
+        self.courier_load = MetricSummary([courier_load(s) for s in final_stats], confidence)
+
+    def __repr__(self):
+        return '\n'.join(['total profit: ' + repr(self.total_profit),
+                          'total lost: ' + repr(self.total_lost),
+                          'mean courier load: ' + repr(self.courier_load)])
+
+
+def half_width(std, n, confidence=0.95):
+    """
+    half width of normal approximation confidence interval for the mean
+
+    :param float std: sample standard deviation
+    :param int n: sample size
+    :param float confidence: confidence level
+    :return: float
+    """
+    if n < 2:
+        return math.inf if n == 1 else 0.0
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    return z * std / math.sqrt(n)
+
+
+def spawn_seeds(seed, n_runs):
+    """
+    independent seeds for runs, all derived from one root
+
+    :param seed: int, np.random.SeedSequence or None
+    :param int n_runs: number of runs
+    :return: List[np.random.SeedSequence]
+    """
+    return child_seeds(seed, n_runs)
+
+
+class SequentialStat:
+    """struct: result of replications added until the requested precision"""
+    def __init__(self, final_stats, metric, estimate, target, reached):
+        """
+        :param list[FinalStat] final_stats: statistics of every run
+        :param str metric: name of FinalStat field
+        :param MetricSummary estimate: estimate of the metric mean (n counts sampling units)
+        :param float target: requested half width
+        :param bool reached: the precision is reached (False if the run limit was hit first)
+        """
+        self.final_stats = final_stats
+        self.metric = metric
+        self.estimate = estimate
+        self.target = target
+        self.reached = reached
+
+    def __repr__(self):
+        return '{}: {} after {} runs{}'.format(self.metric, repr(self.estimate), len(self.final_stats),
+                                               '' if self.reached else ' (target {:.2f} not reached)'.format(self.target))
+
+
+def control_variate_summary(values, controls, confidence=0.95):
+    """
+    mean of values corrected by control variate with known zero mean: values - beta * controls,
+    beta = cov(values, controls) / var(controls) minimizes variance of the corrected values
+
+    :param list[float] values: metric value for every sampling unit
+    :param list[float] controls: control value for every sampling unit
+    :param float confidence: confidence level of the interval
+    :return: MetricSummary of corrected values
+    """
+    if len(values) > 2:
+        control_mean = statistics.fmean(controls)
+        value_mean = statistics.fmean(values)
+        variance = sum((c - control_mean) ** 2 for c in controls)
+        covariance = sum((c - control_mean) * (v - value_mean) for c, v in zip(controls, values))
+        beta = covariance / variance if variance > 0 else 0.0
+        values = [v - beta * c for v, c in zip(values, controls)]
+    return MetricSummary(values, confidence)
+
+
+def run_replica(drugs_file, orders_file, params, seed, cache_dir=None, antithetic=None):
+    """
+    one independent emulation run (executed in a worker process)
+
+    :param str cache_dir: directory of ResultCache or None
+    :param bool antithetic: see Simulation
+    :return: FinalStat
+    """
+    engine = 'Simulation' if antithetic is None else 'Simulation:antithetic={}'.format(antithetic)
+    return cached_run(cache_dir, run_key(drugs_file, orders_file, params, seed, engine) if cache_dir else None,
+                      lambda: Simulation(drugs_file, orders_file, params, seed=seed, antithetic=antithetic).run())
+
+
+def run_replica_batch(drugs_file, orders_file, params, seed, n_replicas, cache_dir=None):
+    """
+    several independent runs in one BatchedEnv (executed in a worker process)
+
+    :param str cache_dir: directory of ResultCache or None
+    :return: List[FinalStat]
+    """
+    key = run_key(drugs_file, orders_file, params, seed, 'BatchedEnv:{}'.format(n_replicas)) if cache_dir else None
+    return cached_run(cache_dir, key, lambda: BatchedEnv(drugs_file, orders_file, params, n_replicas, seed=seed).run())
+
+
+def run_replications(drugs_file, orders_file, params, n_runs, seed=None, workers=None, confidence=0.95,
+                     batch_size=None, cache_dir=None):
+    """
+    run independent emulations in a process pool
+
+    :param str drugs_file: file with drugs
+    :param str orders_file: file with repeating orders
+    :param UserParams params: emulation parameters
+    :param int n_runs: number of replications
+    :param seed: root seed; every run gets its own stream spawned from it
+    :param int workers: number of processes (all cores if None)
+    :param float confidence: confidence level of the intervals
+    :param int batch_size: emulate up to batch_size runs together in every BatchedEnv (one Env per run if None)
+    :param str cache_dir: directory of ResultCache: runs with the same data, parameters and seeds are not repeated
+    :return: ReplicationStat
+    """
+    if batch_size:
+        sizes = [min(batch_size, n_runs - start) for start in range(0, n_runs, batch_size)]
+        seeds = spawn_seeds(seed, len(sizes))
+        n = len(seeds)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            batches = executor.map(run_replica_batch, [drugs_file] * n, [orders_file] * n, [params] * n, seeds,
+                                   sizes, [cache_dir] * n)
+            final_stats = [stat for batch in batches for stat in batch]
+        return ReplicationStat(final_stats, confidence)
+    seeds = spawn_seeds(seed, n_runs)
+    n = len(seeds)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        final_stats = list(executor.map(run_replica, [drugs_file] * n, [orders_file] * n, [params] * n, seeds,
+                                        [cache_dir] * n))
+    return ReplicationStat(final_stats, confidence)
+
+
+def run_until_precision(drugs_file, orders_file, params, target, metric='total_profit', seed=None, workers=None,
+                        confidence=0.95, relative=False, antithetic=False, control_variate=False, min_runs=10,
+                        max_runs=1000, cache_dir=None):
+    """
+    add replications in rounds until half width of confidence interval of metric mean is not more than target;
+    the size of the next round is estimated from the variance observed so far
+
+    with antithetic runs go in pairs with the same purchase uniforms u and 1 - u, and the mean of a pair is
+    one sampling unit; with control_variate every unit is corrected by deviation of purchases from their
+    expectation (known from demand intensity) weighted by margins or base prices, see control_variate_summary
+
+    :param str drugs_file: file with drugs
+    :param str orders_file: file with repeating orders
+    :param UserParams params: emulation parameters
+    :param float target: requested half width (fraction of the mean if relative)
+    :param str metric: 'total_profit' or 'total_lost'
+    :param seed: root seed; every run gets its own stream spawned from it
+    :param int workers: number of processes (all cores if None)
+    :param float confidence: confidence level of the interval
+    :param bool relative: target is relative to the absolute value of the mean
+    :param bool antithetic: use antithetic pairs of runs
+    :param bool control_variate: correct the metric by demand deviation
+    :param int min_runs: runs of the first round
+    :param int max_runs: limit of runs (at least 2 sampling units)
+    :param str cache_dir: directory of ResultCache or None
+    :return: SequentialStat
+    :raise ValueError: if max_runs is less than 2 sampling units
+    """
+    per_unit = 2 if antithetic else 1
+    if max_runs < 2 * per_unit:
+        raise ValueError('max_runs must be at least {} to estimate the interval'.format(2 * per_unit))
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    final_stats = []
+    values = []
+    controls = []
+    n_units = max(min_runs // per_unit, 3)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            n_units = min(n_units, (max_runs - len(final_stats)) // per_unit)
+            seeds = child_seeds(seed, n_units, len(values))
+            if antithetic:
+                seeds = [s for s in seeds for _ in range(2)]
+                flags = [False, True] * n_units
+            else:
+                flags = [None] * n_units
+            n = len(seeds)
+            stats = list(executor.map(run_replica, [drugs_file] * n, [orders_file] * n, [params] * n, seeds,
+                                      [cache_dir] * n, flags))
+            final_stats.extend(stats)
+            for start in range(0, n, per_unit):
+                unit = stats[start:start + per_unit]
+                values.append(statistics.fmean(getattr(s, metric) for s in unit))
+                controls.append(statistics.fmean(getattr(s, CONTROLS[metric]) or 0.0 for s in unit))
+            if control_variate:
+                estimate = control_variate_summary(values, controls, confidence)
+            else:
+                estimate = MetricSummary(values, confidence)
+            goal = target * abs(estimate.mean) if relative else target
+            reached = len(values) > 1 and estimate.half_width <= goal
+            if reached or len(final_stats) + per_unit > max_runs:
+                return SequentialStat(final_stats, metric, estimate, goal, reached)
+            needed = math.ceil((z * estimate.std / goal) ** 2) if goal > 0 else math.inf
+            n_units = max(min(needed, 2 * len(values)) - len(values), 1)
+
+
+def main(argv=None):
+    parser = build_arg_parser()
+    parser.add_argument('--runs', type=int, default=10, help='number of replications')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='replications emulated together with array operations in one process')
+    parser.add_argument('--target', type=float, default=None,
+                        help='add replications until this half width of confidence interval (--runs is the first round)')
+    parser.add_argument('--metric', choices=['total_profit', 'total_lost'], default='total_profit',
+                        help='metric of --target')
+    parser.add_argument('--relative', action='store_true', help='--target is a fraction of the mean')
+    parser.add_argument('--antithetic', action='store_true', help='antithetic pairs of runs (with --target)')
+    parser.add_argument('--control-variate', action='store_true',
+                        help='correct metric by deviation of demand from expectation (with --target)')
+    parser.add_argument('--max-runs', type=int, default=1000, help='limit of replications (with --target)')
+    args = parser.parse_args(argv)
+    params = make_user_params(args.n_days, args.orders_scale, args.couriers, args.card_sale / 100.0,
+                              args.quant_to_reorder)
+    if args.target is not None:
+        stat = run_until_precision(args.drugs_file, args.orders_file, params, args.target, args.metric, args.seed,
+                                   args.workers, relative=args.relative, antithetic=args.antithetic,
+                                   control_variate=args.control_variate, min_runs=args.runs,
+                                   max_runs=args.max_runs, cache_dir=args.cache_dir)
+        print(stat)
+        return stat
+    stat = run_replications(args.drugs_file, args.orders_file, params, args.runs, args.seed, args.workers,
+                            batch_size=args.batch_size, cache_dir=args.cache_dir)
+    print(stat)
+    return stat
+
+
+if __name__ == '__main__':
+    main()
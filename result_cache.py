@@ -0,0 +1,207 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+# modules whose source changes results of emulation
+CODE_MODULES = ('pharmacy', 'batch_store', 'catalog', 'demand', 'orders', 'settlement', 'stat_sink',
+                'simulation', 'batched')
+
+_code_version = None
+_digests = {}
+_caches = {}
+
+
+def code_version():
+    """:return: str hash of source of emulation modules (computed once per process)"""
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in CODE_MODULES:
+            with open(os.path.join(directory, name + '.py'), 'rb') as file:
+                digest.update(name.encode() + b'\0' + file.read() + b'\0')
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def content_digest(path):
+    """
+    hash of file contents or of all files of directory (compiled catalog);
+    remembered for unchanged files (the same size and modification time)
+
+    :param str path:
+    :return: str
+    """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path))
+    else:
+        files = [path]
+    stamp = tuple((name, os.stat(name).st_size, os.stat(name).st_mtime_ns) for name in files)
+    digest = _digests.get(path)
+    if digest is not None and digest[0] == stamp:
+        return digest[1]
+    hasher = hashlib.sha256()
+    for name in files:
+        hasher.update(os.path.basename(name).encode() + b'\0')
+        with open(name, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                hasher.update(block)
+    _digests[path] = (stamp, hasher.hexdigest())
+    return _digests[path][1]
+
+
+def seed_token(seed):
+    """
+    :param seed: int or np.random.SeedSequence
+    :return: str stable description of seed; None for random runs (seed is None)
+    """
+    if seed is None:
+        return None
+    if hasattr(seed, 'entropy'):
+        return 'seq:{}:{}'.format(seed.entropy, tuple(seed.spawn_key))
+    return 'int:{}'.format(int(seed))
+
+
+def run_key(drugs_file, orders_file, params, seed, engine='Simulation'):
+    """
+    content address of emulation run
+
+    :param str drugs_file: file with drugs or compiled catalog directory
+    :param str orders_file: file with repeating orders
+    :param UserParams params: all fields (with n_days) are a part of the key
+    :param seed: int or np.random.SeedSequence
+    :param str engine: what produced the result (engine, statistics sink, number of replicas...)
+    :return: str sha256 hex digest or None if the run is not reproducible (no seed)
+    """
+    token = seed_token(seed)
+    if token is None:
+        return None
+    parts = [code_version(), engine, content_digest(drugs_file), content_digest(orders_file), token,
+             repr(sorted(vars(params).items()))]
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    results of emulation runs on local disk: one pickle file per key, the least recently used
+    files are removed when total size exceeds the cap; safe for several processes
+    (files are written atomically)
+    """
+    def __init__(self, path, max_bytes=256 * 2 ** 20):
+        """
+        :param str path: cache directory
+        :param int max_bytes: size cap
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.__size = None
+
+    def __file(self, key):
+        return os.path.join(self.path, key[:2], key + '.pkl')
+
+    def get(self, key):
+        """
+        :param str key: see run_key
+        :return: cached result or None
+        """
+        if key is None:
+            return None
+        filename = self.__file(key)
+        try:
+            with open(filename, 'rb') as file:
+                result = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """
+        :param str key: see run_key (nothing is stored for None)
+        :param result: picklable result (FinalStat, list of them...)
+        """
+        if key is None:
+            return
+        filename = self.__file(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_name, filename)
+        if self.__size is None:
+            self.__size = self.size()
+        else:
+            self.__size += len(data)
+        if self.__size > self.max_bytes:
+            self.evict()
+
+    def get_or_run(self, key, run):
+        """
+        :param str key: see run_key
+        :param run: function without arguments computing the result
+        :return: cached or computed result
+        """
+        result = self.get(key)
+        if result is None:
+            result = run()
+            self.put(key, result)
+        return result
+
+    def __entries(self):
+        """:return: List[(mtime, size, filename)]"""
+        entries = []
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith('.pkl'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """:return: int total size of cached results"""
+        return sum(size for _, size, _ in self.__entries())
+
+    def evict(self, target=None):
+        """
+        remove the least recently used results until size is not more than target
+
+        :param int target: 90% of size cap if None
+        """
+        target = int(self.max_bytes * 0.9) if target is None else target
+        entries = sorted(self.__entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+        self.__size = total
+
+    def clear(self):
+        self.evict(0)
+
+
+def cached_run(cache_dir, key, run):
+    """
+    :param str cache_dir: cache directory or None (no caching)
+    :param str key: see run_key
+    :param run: function without arguments computing the result
+    :return: cached or computed result
+    """
+    if cache_dir is None or key is None:
+        return run()
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = _caches[cache_dir] = ResultCache(cache_dir)
+    return cache.get_or_run(key, run)
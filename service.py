@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+from catalog import DrugCatalog
+from pharmacy import load_recurring_orders
+from progress import ProgressThrottle
+from replication import ReplicationStat, spawn_seeds
+from result_cache import content_digest
+from simulation import Simulation, make_user_params
+
+PARAMS_FIELDS = ('n_days', 'orders_scale', 'couriers', 'card_sale', 'quant_to_reorder')
+
+
+class FairQueue:
+    """
+    queue of work items of several clients: every client has its own FIFO queue and items are taken
+    from clients in turn (round robin), so a client with many replications does not hold up the others
+    """
+    def __init__(self):
+        # client -> deque of items; the next item is taken from the first client
+        self.__queues = collections.OrderedDict()
+        self.__waiters = collections.deque()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.__queues.values())
+
+    def put(self, client, item):
+        """
+        :param client: hashable client id
+        :param item: work item
+        """
+        self.__queues.setdefault(client, collections.deque()).append(item)
+        while self.__waiters:
+            waiter = self.__waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def get(self):
+        """:return: the next item (waits for it)"""
+        while not self.__queues:
+            waiter = asyncio.get_running_loop().create_future()
+            self.__waiters.append(waiter)
+            await waiter
+        client, queue = self.__queues.popitem(last=False)
+        item = queue.popleft()
+        if queue:
+            self.__queues[client] = queue
+        return item
+
+    def drop(self, client, predicate=None):
+        """
+        remove waiting items of client
+
+        :param client: client id
+        :param predicate: function (item) -> bool selecting items to remove (all if None)
+        :return: int number of removed items
+        """
+        queue = self.__queues.get(client)
+        if queue is None:
+            return 0
+        kept = collections.deque(item for item in queue if predicate is not None and not predicate(item))
+        removed = len(queue) - len(kept)
+        if kept:
+            self.__queues[client] = kept
+        else:
+            del self.__queues[client]
+        return removed
+
+
+class _Run:
+    """struct: one replication of a scenario waiting for a worker"""
+    def __init__(self, job, index, seed):
+        self.job = job
+        self.index = index
+        self.seed = seed
+
+
+class _Job:
+    """struct: scenario request of a client: its runs and the stream of events for the client"""
+    def __init__(self, request_id, client, drugs_file, orders_file, params, n_runs, progress_interval):
+        self.request_id = request_id
+        self.client = client
+        self.drugs_file = drugs_file
+        self.orders_file = orders_file
+        self.params = params
+        self.n_runs = n_runs
+        self.progress_interval = progress_interval
+        self.final_stats = [None] * n_runs
+        self.done = 0
+        self.cancelled = False
+        self.events = asyncio.Queue()
+
+
+def _preloaded(cache, drugs_file, orders_file):
+    """
+    catalog and repeating orders of worker; files are parsed again only when their contents change
+
+    :param dict cache: (drugs_file, orders_file) -> (digests, DrugCatalog, list)
+    :return: (DrugCatalog, list)
+    """
+    key = (drugs_file, orders_file)
+    digests = (content_digest(drugs_file), content_digest(orders_file))
+    entry = cache.get(key)
+    if entry is None or entry[0] != digests:
+        catalog = DrugCatalog.open(drugs_file)
+        entry = cache[key] = (digests, catalog, load_recurring_orders(orders_file, catalog))
+    return entry[1], entry[2]
+
+
+def _serve_runs(conn, preload):
+    """
+    warm worker process loop: keeps catalogs and repeating orders loaded between runs
+
+    commands: ('run', run id, drugs_file, orders_file, params, seed, progress interval) -> ('progress', run id,
+    day, n_days, total profit)* and ('result', run id, FinalStat) or ('error', run id, message); ('stop',)
+    """
+    cache = {}
+    for drugs_file, orders_file in preload:
+        _preloaded(cache, drugs_file, orders_file)
+    while True:
+        command = conn.recv()
+        if command[0] != 'run':
+            break
+        _, run_id, drugs_file, orders_file, params, seed, interval = command
+        try:
+            catalog, recurring_orders = _preloaded(cache, drugs_file, orders_file)
+            env = Simulation(catalog, recurring_orders, params, seed=seed).env
+            progress = None
+            if interval is not None:
+                progress = ProgressThrottle(lambda p: conn.send(('progress', run_id, p.cur_day, p.n_days,
+                                                                 p.total_profit)), interval)
+            conn.send(('result', run_id, env.run_to_end(progress)))
+        except Exception as error:
+            conn.send(('error', run_id, '{}: {}'.format(type(error).__name__, error)))
+    conn.close()
+
+
+class WhatIfService:
+    """
+    local service running emulation scenarios of many clients in a pool of warm worker processes
+
+    clients send newline separated json requests over a unix socket or localhost tcp and get
+    json events of the request back: 'progress' of runs, then 'result' with FinalStat of every run
+    (and summary of replications) or 'error'; replications are queued fairly between clients
+    and waiting runs of a disconnected client are dropped
+    """
+    def __init__(self, workers=None, preload=(), progress_interval=0.5):
+        """
+        :param int workers: number of worker processes (all cores if None)
+        :param list preload: (drugs_file, orders_file) pairs loaded by every worker at start
+        :param float progress_interval: default min seconds between progress events of a run
+        """
+        self.n_workers = workers or os.cpu_count() or 1
+        self.preload = list(preload)
+        self.progress_interval = progress_interval
+        self.queue = FairQueue()
+        self.__processes = []
+        self.__tasks = []
+        self.__connections = itertools.count()
+        self.__run_ids = itertools.count()
+
+    async def start(self):
+        """start worker processes and their dispatchers"""
+        self.__processes = [None] * self.n_workers
+        for slot in range(self.n_workers):
+            self.__start_worker(slot)
+            self.__tasks.append(asyncio.create_task(self.__dispatch(slot)))
+
+    async def stop(self):
+        """stop dispatchers and worker processes"""
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        for process, conn in self.__processes:
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass
+            conn.close()
+            process.join(timeout=5)
+        self.__processes = []
+        self.__tasks = []
+
+    def __start_worker(self, slot):
+        """start worker process of the slot (in place of the stopped one)"""
+        context = multiprocessing.get_context()
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_serve_runs, args=(child_conn, self.preload), daemon=True)
+        process.start()
+        child_conn.close()
+        self.__processes[slot] = (process, parent_conn)
+
+    async def __dispatch(self, slot):
+        """
+        give queued runs to the worker of the slot one by one and route its messages to jobs;
+        a worker which stopped is started again and the job of its current run fails
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            process, conn = self.__processes[slot]
+            messages = asyncio.Queue()
+
+            def receive():
+                try:
+                    messages.put_nowait(conn.recv())
+                except (EOFError, OSError):
+                    loop.remove_reader(conn.fileno())
+                    messages.put_nowait(('stopped', None))
+
+            loop.add_reader(conn.fileno(), receive)
+            try:
+                await self.__feed_worker(conn, messages)
+            finally:
+                loop.remove_reader(conn.fileno())
+            conn.close()
+            process.kill()
+            process.join()
+            self.__start_worker(slot)
+
+    async def __feed_worker(self, conn, messages):
+        """
+        give queued runs to one worker until it stops
+
+        :param conn: connection to the worker
+        :param asyncio.Queue messages: messages of the worker, ('stopped', None) after the last one
+        """
+        while True:
+            run = await self.queue.get()
+            job = run.job
+            if job.cancelled:
+                continue
+            if not messages.empty():
+                # the worker stopped while waiting for the run
+                self.queue.put(job.client, run)
+                return
+            run_id = next(self.__run_ids)
+            try:
+                conn.send(('run', run_id, job.drugs_file, job.orders_file, job.params, run.seed,
+                           job.progress_interval))
+            except OSError:
+                self.queue.put(job.client, run)
+                return
+            while True:
+                kind, message_run_id, *payload = await messages.get()
+                if kind == 'stopped':
+                    self.__fail(job, 'worker process stopped')
+                    return
+                if message_run_id != run_id:
+                    continue
+                if kind == 'progress':
+                    job.events.put_nowait({'event': 'progress', 'run': run.index, 'day': payload[0],
+                                           'n_days': payload[1], 'total_profit': payload[2]})
+                    continue
+                if kind == 'result':
+                    job.final_stats[run.index] = payload[0]
+                    job.done += 1
+                    if job.done == job.n_runs:
+                        job.events.put_nowait(self.__result_event(job))
+                else:
+                    self.__fail(job, payload[0])
+                break
+
+    def __fail(self, job, message):
+        """cancel waiting runs of job and send error to its client (once)"""
+        if job.cancelled:
+            return
+        job.cancelled = True
+        self.queue.drop(job.client, lambda item: item.job is job)
+        job.events.put_nowait({'event': 'error', 'message': message})
+
+    @staticmethod
+    def __result_event(job):
+        event = {'event': 'result', 'runs': [vars(stat) for stat in job.final_stats]}
+        if job.n_runs > 1:
+            stat = ReplicationStat(job.final_stats)
+            event['summary'] = {name: {'mean': summary.mean, 'half_width': summary.half_width}
+                                for name, summary in (('total_profit', stat.total_profit),
+                                                      ('total_lost', stat.total_lost),
+                                                      ('courier_load', stat.courier_load))}
+        return event
+
+    def submit(self, client, request):
+        """
+        queue runs of a scenario
+
+        :param client: client id (requests of one client share its turn in the queue)
+        :param dict request: drugs_file, orders_file, params (dict of UserParams fields), optional seed,
+            replications, progress_interval (None - no progress events) and id
+        :return: _Job
+        """
+        params = make_user_params(*(request['params'][name] for name in PARAMS_FIELDS))
+        n_runs = int(request.get('replications', 1))
+        if n_runs < 1:
+            raise ValueError('replications must be positive')
+        for name in ('drugs_file', 'orders_file'):
+            if not os.path.exists(request[name]):
+                raise ValueError('no such file: ' + request[name])
+        job = _Job(request.get('id'), client, request['drugs_file'], request['orders_file'], params, n_runs,
+                   request.get('progress_interval', self.progress_interval))
+        for index, seed in enumerate(spawn_seeds(request.get('seed'), n_runs)):
+            self.queue.put(client, _Run(job, index, seed))
+        return job
+
+    async def handle_connection(self, reader, writer):
+        """serve requests of one connection; they run concurrently, events carry id of their request"""
+        connection = next(self.__connections)
+        lock = asyncio.Lock()
+        streams = []
+        jobs = []
+
+        async def send(message):
+            async with lock:
+                writer.write(json.dumps(message, default=_to_json).encode() + b'\n')
+                await writer.drain()
+
+        async def stream(job):
+            while True:
+                event = await job.events.get()
+                event['id'] = job.request_id
+                await send(event)
+                if event['event'] != 'progress':
+                    return
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                scenario = None
+                try:
+                    scenario = json.loads(line)
+                    job = self.submit(scenario.get('client', connection), scenario)
+                except (ValueError, KeyError, TypeError, AttributeError) as error:
+                    request_id = scenario.get('id') if isinstance(scenario, dict) else None
+                    await send({'event': 'error', 'id': request_id, 'message': '{}: {}'.format(
+                        type(error).__name__, error)})
+                    continue
+                jobs.append(job)
+                streams.append(asyncio.create_task(stream(job)))
+            await asyncio.gather(*streams)
+        except ConnectionError:
+            pass
+        finally:
+            for job in jobs:
+                job.cancelled = True
+                self.queue.drop(job.client, lambda item: item.job is job)
+            for task in streams:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, socket_path=None, port=None):
+        """
+        run until cancelled
+
+        :param str socket_path: unix socket path
+        :param int port: localhost tcp port (if socket_path is None)
+        """
+        await self.start()
+        try:
+            if socket_path is not None:
+                server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+            else:
+                server = await asyncio.start_server(self.handle_connection, host='127.0.0.1', port=port)
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+def _to_json(value):
+    """json encoding of numpy values in FinalStat"""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+async def request(scenario, socket_path=None, port=None, on_progress=None):
+    """
+    send one scenario to the service and wait for its result
+
+    :param dict scenario: see WhatIfService.submit
+    :param str socket_path: unix socket of the service
+    :param int port: localhost tcp port of the service (if socket_path is None)
+    :param on_progress: function (dict progress event) or None
+    :return: dict result event
+    :raise RuntimeError: on error event
+    """
+    if socket_path is not None:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    else:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(json.dumps(scenario).encode() + b'\n')
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise RuntimeError('service closed connection')
+            event = json.loads(line)
+            if event['event'] == 'progress':
+                if on_progress is not None:
+                    on_progress(event)
+            elif event['event'] == 'error':
+                raise RuntimeError(event['message'])
+            else:
+                return event
+    finally:
+        writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='local service for what-if emulation scenarios')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='run the service')
+    serve.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    serve.add_argument('--preload', nargs=2, action='append', default=[], metavar=('DRUGS_FILE', 'ORDERS_FILE'),
+                       help='files loaded by workers at start (may repeat)')
+    run = commands.add_parser('run', help='send a scenario to the service')
+    run.add_argument('drugs_file', help='file with drugs')
+    run.add_argument('orders_file', help='file with repeating orders')
+    run.add_argument('--n-days', type=int, required=True, help='emulation period (days)')
+    run.add_argument('--orders-scale', type=float, required=True, help='orders flow density')
+    run.add_argument('--couriers', type=int, required=True, help='number of couriers')
+    run.add_argument('--card-sale', type=float, required=True, help='sale for card owners (%%)')
+    run.add_argument('--quant-to-reorder', type=int, required=True, help='minimal quantity of drug before reorder')
+    run.add_argument('--seed', type=int, default=None, help='seed for reproducible runs')
+    run.add_argument('--replications', type=int, default=1, help='number of runs')
+    for command in (serve, run):
+        address = command.add_mutually_exclusive_group(required=True)
+        address.add_argument('--socket', default=None, help='unix socket path')
+        address.add_argument('--port', type=int, default=None, help='localhost tcp port')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        service = WhatIfService(args.workers, [tuple(pair) for pair in args.preload])
+        try:
+            asyncio.run(service.serve(args.socket, args.port))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    scenario = {'drugs_file': os.path.abspath(args.drugs_file), 'orders_file': os.path.abspath(args.orders_file),
+                'params': {'n_days': args.n_days, 'orders_scale': args.orders_scale, 'couriers': args.couriers,
+                           'card_sale': args.card_sale / 100.0, 'quant_to_reorder': args.quant_to_reorder},
+                'seed': args.seed, 'replications': args.replications}
+
+    def show_progress(event):
+        print('run {} day {}/{} profit {:.0f}'.format(event['run'], event['day'], event['n_days'],
+                                                      event['total_profit']), file=sys.stderr)
+
+    result = asyncio.run(request(scenario, args.socket, args.port, show_progress))
+    if 'summary' in result:
+        for name, summary in result['summary'].items():
+            print('{}: {:.2f} +- {:.2f}'.format(name, summary['mean'], summary['half_width']))
+    else:
+        stat = result['runs'][0]
+        print('total profit: {:.2f}\ntotal lost: {:.2f}'.format(stat['total_profit'], stat['total_lost']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
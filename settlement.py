@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class SaleRules:
+    """struct: discounts for client orders; defaults are the discounts of the model (used by every engine)"""
+    def __init__(self, card_sale, big_order_thre=1000, big_order_sale=0.03, loyal_sale=0.05, max_sale=0.09):
+        self.card_sale = card_sale
+        self.big_order_thre = big_order_thre
+        self.big_order_sale = big_order_sale
+        self.loyal_sale = loyal_sale
+        self.max_sale = max_sale
+
+
+def allocate_fifo(lines_drug, lines_quant, stock):
+    """
+    give drugs from stock to order lines in order of lines: every line gets min(ordered, rest of stock)
+
+    :param np.ndarray lines_drug: drug id of every line
+    :param np.ndarray lines_quant: ordered quantity of every line
+    :param np.ndarray stock: available quantity of every drug
+    :return: np.ndarray allocated quantity of every line
+    """
+    order = np.argsort(lines_drug, kind='stable')
+    drugs = lines_drug[order]
+    quant = lines_quant[order]
+    # ordered before the line = exclusive cumulative sum inside group of the drug
+    before = np.cumsum(quant) - quant
+    is_group_start = np.r_[True, drugs[1:] != drugs[:-1]] if len(drugs) else np.empty(0, dtype=bool)
+    group_start = np.maximum.accumulate(np.where(is_group_start, np.arange(len(drugs)), 0))
+    before -= before[group_start]
+    allocated = np.empty(len(lines_drug), dtype=np.int64)
+    allocated[order] = np.clip(stock[drugs] - before, 0, quant)
+    return allocated
+
+
+def settle_orders(lines_order, lines_drug, allocated, n_orders, base_prices, cur_prices, has_card, loyal, rules):
+    """
+    calculate incomes and discounts of orders
+
+    incomes of lines are summed in order of lines, so the result is the same as
+    summing them order by order
+
+    :param np.ndarray lines_order: order index of every line (non decreasing)
+    :param np.ndarray lines_drug: drug id of every line
+    :param np.ndarray allocated: allocated quantity of every line
+    :param int n_orders: number of orders
+    :param np.ndarray base_prices: base price of every drug
+    :param np.ndarray cur_prices: current price of every drug
+    :param np.ndarray has_card: bool for every order
+    :param np.ndarray loyal: bool for every order
+    :param SaleRules rules: discounts
+    :return: Tuple(np.ndarray, np.ndarray) - income after discounts and profit of every order
+    """
+    base_income = np.bincount(lines_order, weights=allocated * base_prices[lines_drug], minlength=n_orders)
+    cur_income = np.bincount(lines_order, weights=allocated * cur_prices[lines_drug], minlength=n_orders)
+
+    sale = np.where(has_card, 0.0 + rules.card_sale,
+                    np.where(cur_income > rules.big_order_thre, 0.0 + rules.big_order_sale, 0.0))
+    sale = np.where(loyal, np.minimum(rules.max_sale, sale + rules.loyal_sale), sale)
+
+    cur_income = cur_income - cur_income * sale
+    return cur_income, cur_income - base_income
@@ -0,0 +1,153 @@
+import argparse
+
+import numpy as np
+
+from pharmacy import Env, Randomizer, UserParams
+from profiling import profiler
+from result_cache import cached_run, run_key
+from stat_sink import AggregateSink
+
+
+class Simulation:
+    """headless emulation run without user interface"""
+    def __init__(self, drugs_file, orders_file, params, randomizer_cls=Randomizer, seed=None, stat_sink=None,
+                 antithetic=None):
+        """
+        :param str drugs_file: file with drugs
+        :param str orders_file: file with repeating orders
+        :param UserParams params: emulation parameters
+        :param randomizer_cls: randomizer class
+        :param seed: int or np.random.SeedSequence for reproducible run; None for random one
+        :param StatSink stat_sink: receiver of daily statistics; AggregateSink (constant memory) if None
+        :param bool antithetic: None - purchases are drawn from demand stream; False or True - purchases are
+            drawn by inverse CDF from the third stream of seed, True uses antithetic uniforms of this stream
+        """
+        self.params = params
+        seeds = child_seeds(seed, 2 if antithetic is None else 3)
+        demand_seed, supplier_seed = seeds[:2]
+        self.env = Env(GUI=None, randomizer_cls=randomizer_cls, drugs_file=drugs_file, orders_file=orders_file,
+                       rng=np.random.default_rng(demand_seed), supplier_rng=np.random.default_rng(supplier_seed),
+                       stat_sink=stat_sink if stat_sink is not None else AggregateSink())
+        if antithetic is not None:
+            self.env.randomizer.set_purchase_rng(np.random.default_rng(seeds[2]), antithetic)
+        self.env.init_user_parameters(params)
+
+    def run(self):
+        """
+        emulate all days at once
+
+        :return: FinalStat
+        """
+        return self.env.start_next_day(no_tmp=True)
+
+
+def make_seed_sequence(seed):
+    """
+    :param seed: int, np.random.SeedSequence or None
+    :return: np.random.SeedSequence
+    """
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+
+def child_seeds(seed, n, start=0):
+    """
+    n children of seed from the given one; unlike SeedSequence.spawn the seed is not changed, so every run
+    with the same seed object gets the same streams
+
+    :param seed: int, np.random.SeedSequence or None
+    :param int n: number of children
+    :param int start: index of the first child (children of later rounds follow the earlier ones)
+    :return: List[np.random.SeedSequence]
+    """
+    seed = make_seed_sequence(seed)
+    return [np.random.SeedSequence(seed.entropy, spawn_key=tuple(seed.spawn_key) + (i,), pool_size=seed.pool_size)
+            for i in range(start, start + n)]
+
+
+def make_user_params(n_days, orders_scale, couriers, card_sale, quant_to_reorder):
+    """
+    build UserParams from plain values
+
+    :param int n_days: emulation period (days)
+    :param float orders_scale: orders flow density
+    :param int couriers: number of couriers
+    :param float card_sale: sale for card owners (fraction, not percent)
+    :param int quant_to_reorder: minimal quantity of drug before reorder
+    :return: UserParams
+    """
+    params = UserParams()
+    params.n_days = n_days
+    params.orders_scale = orders_scale
+    params.couriers = couriers
+    params.card_sale = card_sale
+    params.quant_to_reorder = quant_to_reorder
+    return params
+
+
+def courier_load(stat):
+    """
+    mean couriers load over emulation (ready orders / max orders per day)
+
+    :param FinalStat stat:
+    :return: float
+    """
+    if stat.courier_load_mean is not None:
+        return stat.courier_load_mean
+    if not stat.delivered_history:
+        return 0.0
+    return sum(stat.delivered_history) / len(stat.delivered_history) / stat.courier_max_load
+
+
+def format_final_stat(stat):
+    """
+    text report for final statistics
+
+    :param FinalStat stat:
+    :return: str
+    """
+    return '\n'.join(['total profit: ' + str(round(stat.total_profit, 2)),
+                      'total lost: ' + str(round(stat.total_lost, 2)),
+                      'courier max load: ' + str(stat.courier_max_load),
+                      'mean courier load: ' + str(round(courier_load(stat), 2))])
+
+
+def build_arg_parser():
+    """command line arguments for headless emulation"""
+    parser = argparse.ArgumentParser(description='headless pharmacy emulation')
+    parser.add_argument('drugs_file', help='file with drugs')
+    parser.add_argument('orders_file', help='file with repeating orders')
+    parser.add_argument('--n-days', type=int, required=True, help='emulation period (days)')
+    parser.add_argument('--orders-scale', type=float, required=True, help='orders flow density')
+    parser.add_argument('--couriers', type=int, required=True, help='number of couriers')
+    parser.add_argument('--card-sale', type=float, required=True, help='sale for card owners (%%)')
+    parser.add_argument('--quant-to-reorder', type=int, required=True,
+                        help='minimal quantity of drug before reorder')
+    parser.add_argument('--seed', type=int, default=None, help='seed for reproducible run')
+    parser.add_argument('--cache-dir', default=None, help='directory for cached results of seeded runs')
+    parser.add_argument('--profile', action='store_true',
+                        help='print time of emulation phases (also PHARMACY_PROFILE=1)')
+    parser.add_argument('--trace', default=None, help='write Chrome trace of emulation phases to the file')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    params = make_user_params(args.n_days, args.orders_scale, args.couriers, args.card_sale / 100.0,
+                              args.quant_to_reorder)
+    if args.profile or args.trace:
+        profiler.enable()
+    if args.cache_dir and not (args.profile or args.trace):
+        stat = cached_run(args.cache_dir, run_key(args.drugs_file, args.orders_file, params, args.seed),
+                          lambda: Simulation(args.drugs_file, args.orders_file, params, seed=args.seed).run())
+    else:
+        stat = Simulation(args.drugs_file, args.orders_file, params, seed=args.seed).run()
+    print(format_final_stat(stat))
+    if profiler.enabled:
+        print(profiler.format_summary())
+    if args.trace:
+        profiler.write_trace(args.trace)
+    return stat
+
+
+if __name__ == '__main__':
+    main()
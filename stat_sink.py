@@ -0,0 +1,206 @@
+import json
+import math
+import os
+
+import numpy as np
+
+
+class StatSink:
+    """
+    receiver of daily statistics of pharmacy; gets one record per day
+    and fills final statistics after the last day
+    """
+    def add_day(self, day, ordered, delivered, courier_max_load, profit, lost):
+        """
+        :param int day: number of the day
+        :param int ordered: number of ready orders
+        :param int delivered: number of delivered orders
+        :param int courier_max_load: max orders couriers can deliver
+        :param float profit: profit of the day
+        :param float lost: lost from written off drugs of the day
+        """
+        raise NotImplementedError
+
+    def fill_final(self, stat):
+        """
+        :param FinalStat stat: statistics to fill
+        """
+        raise NotImplementedError
+
+
+class NullSink(StatSink):
+    """sink which keeps nothing"""
+    def add_day(self, day, ordered, delivered, courier_max_load, profit, lost):
+        pass
+
+    def fill_final(self, stat):
+        pass
+
+
+class HistorySink(StatSink):
+    """keeps number of ready orders of every day (for final statistics window)"""
+    def __init__(self):
+        self.delivered_history = []
+
+    def add_day(self, day, ordered, delivered, courier_max_load, profit, lost):
+        self.delivered_history.append(ordered)
+
+    def fill_final(self, stat):
+        stat.delivered_history = self.delivered_history
+        stat.days = len(self.delivered_history)
+        if self.delivered_history and stat.courier_max_load:
+            stat.courier_load_mean = sum(self.delivered_history) / len(self.delivered_history) / stat.courier_max_load
+
+
+class OnlineMoments:
+    """Welford online mean and variance with min and max"""
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    @property
+    def var(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+
+class QuantileSketch:
+    """
+    quantiles of non negative values with bounded relative error:
+    values are counted in logarithmic buckets (gamma = (1 + accuracy) / (1 - accuracy))
+    """
+    def __init__(self, accuracy=0.01):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.n = 0
+
+    def add(self, x):
+        self.n += 1
+        if x <= 0:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(x) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def quantile(self, q):
+        """
+        :param float q: from 0 to 1
+        :return: float approximate quantile or None if empty
+        """
+        if self.n == 0:
+            return None
+        rank = q * (self.n - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class AggregateSink(StatSink):
+    """online aggregates in constant memory: moments of courier load, profit and lost per day, load quantiles"""
+    def __init__(self, quantiles=(0.5, 0.9, 0.99), accuracy=0.01):
+        """
+        :param quantiles: courier load quantiles for final statistics
+        :param float accuracy: relative accuracy of quantiles
+        """
+        self.quantiles = quantiles
+        self.courier_load = OnlineMoments()
+        self.profit = OnlineMoments()
+        self.lost = OnlineMoments()
+        self.courier_load_sketch = QuantileSketch(accuracy)
+        self.delivered = 0
+
+    def add_day(self, day, ordered, delivered, courier_max_load, profit, lost):
+        load = ordered / courier_max_load if courier_max_load else 0.0
+        self.courier_load.add(load)
+        self.courier_load_sketch.add(load)
+        self.profit.add(profit)
+        self.lost.add(lost)
+        self.delivered += delivered
+
+    def fill_final(self, stat):
+        stat.days = self.courier_load.n
+        stat.courier_load_mean = self.courier_load.mean
+        stat.courier_load_std = math.sqrt(self.courier_load.var)
+        stat.courier_load_max = self.courier_load.max if self.courier_load.n else 0.0
+        stat.courier_load_quantiles = {q: self.courier_load_sketch.quantile(q) for q in self.quantiles}
+        stat.total_delivered = self.delivered
+
+
+class ColumnarLogSink(StatSink):
+    """
+    append-only on-disk log: one binary file per column in a directory, records are buffered
+    and appended every flush_every days; read it with read_log
+    """
+    COLUMNS = (('day', np.int64), ('ordered', np.int64), ('delivered', np.int64),
+               ('courier_max_load', np.int64), ('profit', np.float64), ('lost', np.float64))
+
+    def __init__(self, path, flush_every=1000, inner=None):
+        """
+        :param str path: directory of the log
+        :param int flush_every: number of buffered days
+        :param StatSink inner: sink which also gets records and fills final statistics (AggregateSink if None)
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.inner = inner if inner is not None else AggregateSink()
+        self.__buffer = []
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'columns.json'), 'w') as file:
+            json.dump([[name, np.dtype(dtype).str] for name, dtype in self.COLUMNS], file)
+        for name, _ in self.COLUMNS:
+            open(os.path.join(path, name + '.bin'), 'wb').close()
+
+    def add_day(self, day, ordered, delivered, courier_max_load, profit, lost):
+        self.__buffer.append((day, ordered, delivered, courier_max_load, profit, lost))
+        self.inner.add_day(day, ordered, delivered, courier_max_load, profit, lost)
+        if len(self.__buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """append buffered records to column files"""
+        if not self.__buffer:
+            return
+        for values, (name, dtype) in zip(zip(*self.__buffer), self.COLUMNS):
+            with open(os.path.join(self.path, name + '.bin'), 'ab') as file:
+                np.asarray(values, dtype=dtype).tofile(file)
+        self.__buffer = []
+
+    def fill_final(self, stat):
+        self.flush()
+        self.inner.fill_final(stat)
+        stat.log_path = self.path
+
+
+def read_log(path, mmap=True):
+    """
+    :param str path: directory of ColumnarLogSink
+    :param bool mmap: map files to memory instead of reading
+    :return: dict column name -> np.ndarray
+    """
+    with open(os.path.join(path, 'columns.json')) as file:
+        columns = json.load(file)
+    res = {}
+    for name, dtype in columns:
+        filename = os.path.join(path, name + '.bin')
+        if mmap and os.path.getsize(filename):
+            res[name] = np.memmap(filename, dtype=dtype, mode='r')
+        else:
+            res[name] = np.fromfile(filename, dtype=dtype)
+    return res
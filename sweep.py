@@ -0,0 +1,219 @@
+import argparse
+import copy
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from fluid import FluidEnv
+from replication import ReplicationStat, run_replica, spawn_seeds
+from simulation import make_user_params
+
+SWEEP_PARAMS = ('orders_scale', 'couriers', 'card_sale', 'quant_to_reorder')
+
+
+class SweepResult:
+    """struct: aggregated statistics of one parameters configuration"""
+    def __init__(self, config, final_stats, stopped_early, confidence=0.95):
+        """
+        :param dict config: swept parameters values
+        :param list[FinalStat] final_stats: statistics of finished runs
+        :param bool stopped_early: configuration was dropped as clearly dominated
+        :param float confidence: confidence level of the intervals
+        """
+        self.config = config
+        self.stat = ReplicationStat(final_stats, confidence)
+        self.stopped_early = stopped_early
+
+
+def grid_configs(space):
+    """
+    all combinations of parameters values
+
+    :param dict space: parameter name -> list of values
+    :return: List[dict]
+    """
+    names = list(space.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def random_configs(space, n_configs, seed=None):
+    """
+    random parameters configurations
+
+    :param dict space: parameter name -> list of values to choose from or (low, high) range;
+        integer bounds give integer values
+    :param int n_configs: number of configurations
+    :param seed: seed for reproducible choice
+    :return: List[dict]
+    """
+    rng = np.random.default_rng(seed)
+    configs = []
+    for _ in range(n_configs):
+        config = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                if isinstance(low, int) and isinstance(high, int):
+                    config[name] = int(rng.integers(low, high + 1))
+                else:
+                    config[name] = float(rng.uniform(low, high))
+            else:
+                config[name] = values[rng.integers(len(values))]
+        configs.append(config)
+    return configs
+
+
+def apply_config(base_params, config):
+    """
+    :param UserParams base_params: parameters not touched by sweep
+    :param dict config: swept parameters values
+    :return: UserParams
+    """
+    for name in config:
+        if name not in SWEEP_PARAMS:
+            raise ValueError('unknown sweep parameter ' + name)
+    params = copy.copy(base_params)
+    for name, value in config.items():
+        setattr(params, name, value)
+    return params
+
+
+def run_sweep(drugs_file, orders_file, base_params, configs, n_runs, seed=None, workers=None,
+              rounds=1, confidence=0.95, cache_dir=None):
+    """
+    evaluate parameters configurations in a process pool
+
+    replication i of every configuration uses the same seed (common random numbers); purchases are drawn
+    by inverse CDF from their own stream of uniforms (see Randomizer.set_purchase_rng), so configurations
+    with the same demand intensity buy the same quantities and different intensities give monotonically
+    coupled quantities; splitting of purchases into orders still depends on the quantities.
+    with rounds > 1 replications are added round by round and a configuration whose profit interval
+    lies entirely below the interval of the best one is not simulated further
+
+    :param str drugs_file: file with drugs
+    :param str orders_file: file with repeating orders
+    :param UserParams base_params: parameters not touched by sweep (n_days and defaults)
+    :param list[dict] configs: swept parameters values
+    :param int n_runs: maximum number of replications per configuration
+    :param seed: root seed
+    :param int workers: number of processes (all cores if None)
+    :param int rounds: number of rounds for early stopping
+    :param float confidence: confidence level of the intervals
+    :param str cache_dir: directory of ResultCache: runs done in earlier sweeps are taken from it
+    :return: List[SweepResult] ranked by mean profit
+    """
+    seeds = spawn_seeds(seed, n_runs)
+    bounds = np.linspace(0, n_runs, rounds + 1).round().astype(int)
+    all_params = [apply_config(base_params, config) for config in configs]
+    final_stats = [[] for _ in configs]
+    active = list(range(len(configs)))
+    stopped = set()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for round_start, round_end in zip(bounds[:-1], bounds[1:]):
+            tasks = [(i, seeds[j]) for i in active for j in range(round_start, round_end)]
+            results = executor.map(run_replica, [drugs_file] * len(tasks), [orders_file] * len(tasks),
+                                   [all_params[i] for i, _ in tasks], [s for _, s in tasks],
+                                   [cache_dir] * len(tasks), [False] * len(tasks))
+            for (i, _), stat in zip(tasks, results):
+                final_stats[i].append(stat)
+
+            if round_end == n_runs:
+                break
+            summaries = {i: ReplicationStat(final_stats[i], confidence).total_profit for i in active}
+            best_low = max(summary.ci_low for summary in summaries.values())
+            dominated = {i for i in active if summaries[i].ci_high < best_low}
+            stopped |= dominated
+            active = [i for i in active if i not in dominated]
+
+    results = [SweepResult(configs[i], final_stats[i], i in stopped, confidence) for i in range(len(configs))]
+    return sorted(results, key=lambda r: r.stat.total_profit.mean, reverse=True)
+
+
+def run_fluid_sweep(drugs_file, orders_file, base_params, configs):
+    """
+    screen parameters configurations with one deterministic expected-value emulation of all of them
+    (see FluidEnv for its measured error: ranking is kept, profit is within ~6% for most configurations,
+    write-offs are underestimated); intervals are not known, the best configurations should be checked
+    with run_sweep
+
+    :param str drugs_file: file with drugs
+    :param str orders_file: file with repeating orders
+    :param UserParams base_params: parameters not touched by sweep (n_days and defaults)
+    :param list[dict] configs: swept parameters values
+    :return: List[SweepResult] ranked by approximate profit
+    """
+    all_params = [apply_config(base_params, config) for config in configs]
+    final_stats = FluidEnv(drugs_file, orders_file, all_params).run()
+    results = [SweepResult(config, [stat], False) for config, stat in zip(configs, final_stats)]
+    return sorted(results, key=lambda r: r.stat.total_profit.mean, reverse=True)
+
+
+def format_table(results):
+    """
+    text table: profit vs write-off vs couriers load; intervals are left blank for
+    configurations with less than 2 runs (e.g. fluid results)
+
+    :param list[SweepResult] results: ranked results
+    :return: str
+    """
+    names = list(results[0].config.keys()) if results else []
+    header = ['rank'] + names + ['profit', '+-', 'lost', '+-', 'courier load', 'runs', 'stopped']
+    rows = [header]
+    for rank, result in enumerate(results, 1):
+        stat = result.stat
+        interval = '{:.2f}'.format if stat.total_profit.n > 1 else lambda value: ''
+        rows.append([str(rank)] + [str(result.config[name]) for name in names] +
+                    ['{:.2f}'.format(stat.total_profit.mean), interval(stat.total_profit.half_width),
+                     '{:.2f}'.format(stat.total_lost.mean), interval(stat.total_lost.half_width),
+                     '{:.2f}'.format(stat.courier_load.mean), str(stat.total_profit.n),
+                     'yes' if result.stopped_early else ''])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def parse_values(text):
+    """'1,2,3' -> [1, 2, 3]; float if any value has a point"""
+    values = text.split(',')
+    if any('.' in value for value in values):
+        return [float(value) for value in values]
+    return [int(value) for value in values]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='grid search over pharmacy parameters')
+    parser.add_argument('drugs_file', help='file with drugs')
+    parser.add_argument('orders_file', help='file with repeating orders')
+    parser.add_argument('--n-days', type=int, required=True, help='emulation period (days)')
+    parser.add_argument('--orders-scale', type=parse_values, required=True, help='values, comma separated')
+    parser.add_argument('--couriers', type=parse_values, required=True, help='values, comma separated')
+    parser.add_argument('--card-sale', type=parse_values, required=True, help='values (%%), comma separated')
+    parser.add_argument('--quant-to-reorder', type=parse_values, required=True, help='values, comma separated')
+    parser.add_argument('--runs', type=int, default=10, help='replications per configuration')
+    parser.add_argument('--rounds', type=int, default=1, help='rounds for early stopping')
+    parser.add_argument('--seed', type=int, default=None, help='root seed')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--cache-dir', default=None, help='directory for cached results of runs')
+    parser.add_argument('--fluid', action='store_true',
+                        help='quick screening by deterministic expected-value emulation instead of replications '
+                             '(approximate, see FluidEnv)')
+    args = parser.parse_args(argv)
+
+    space = {'orders_scale': args.orders_scale,
+             'couriers': args.couriers,
+             'card_sale': [sale / 100.0 for sale in args.card_sale],
+             'quant_to_reorder': args.quant_to_reorder}
+    base_params = make_user_params(args.n_days, 0, 0, 0, 0)
+    if args.fluid:
+        results = run_fluid_sweep(args.drugs_file, args.orders_file, base_params, grid_configs(space))
+        print(format_table(results))
+        return results
+    results = run_sweep(args.drugs_file, args.orders_file, base_params, grid_configs(space), args.runs,
+                        args.seed, args.workers, args.rounds, cache_dir=args.cache_dir)
+    print(format_table(results))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import numpy as np
+
+from batch_store import BatchStore
+from pharmacy import DAYS_TO_SALE
+
+
+class VirtualStore:
+    """
+    stock, prices and reorders of several pharmacies with the same catalog for array engines
+    (BatchedEnv, FluidEnv)
+
+    every per-drug state is a flat array of n_groups * n_drugs values indexed by virtual drug id =
+    group * n_drugs + drug id (group is a replica or a configuration). the rules are of Pharmacy:
+    overdue batches are written off, drugs close to expiry go on sale at half price, drugs which ran
+    down to the threshold are reordered; only virtual drugs changed since the last check are checked
+    """
+    def __init__(self, catalog, n_groups, demand_model, min_quant_to_reorder, dtype=np.int32):
+        """
+        :param DrugCatalog catalog: drugs of every pharmacy
+        :param int n_groups: number of pharmacies
+        :param DemandModel demand_model: demand curve (intensity is updated with prices)
+        :param min_quant_to_reorder: reorder threshold: int or np.ndarray for every virtual drug
+        :param dtype: type of quantities of batches (see BatchStore)
+        """
+        self.n_groups = n_groups
+        self.n_drugs = len(catalog)
+        n_virtual = n_groups * self.n_drugs
+        self.group_of = np.repeat(np.arange(n_groups), self.n_drugs)
+        self.base_prices = np.tile(catalog.prices, n_groups).astype(np.float64)
+        self.base_profits = np.tile(catalog.profits, n_groups)
+        self.quantities = np.tile(catalog.quantities, n_groups)
+        self.shelf_lives = np.tile(catalog.shelf_lives, n_groups)
+        self.full_prices = self.base_prices * self.base_profits
+        self.cur_prices = self.full_prices.copy()
+        self.cur_profits = self.base_profits.copy()
+        self.intensity = demand_model.intensity(self.base_prices, self.cur_profits)
+        self.drug_store = BatchStore(n_virtual, dtype=dtype)
+        self.lost = np.zeros(n_groups)  # base cost of written off drugs of every pharmacy
+
+        self.__demand_model = demand_model
+        self.__min_quant_to_reorder = np.broadcast_to(min_quant_to_reorder, (n_virtual,))
+        self.__expiry_calendar = {}  # dict(day;List[np.ndarray]) - virtual drugs with batches to write off
+        self.__sale_calendar = {}  # dict(day;List[np.ndarray]) - virtual drugs which batches come close to expiry
+        self.__deliveries = {}  # dict(day;List[np.ndarray]) - virtual drugs delivered by supplier at the day
+        self.__changed = np.zeros(n_virtual, dtype=bool)
+        self.__waiting_to_store = np.zeros(n_virtual, dtype=bool)
+        self.add_batches(np.arange(n_virtual), 0)
+
+    def deliver(self, day):
+        """put drugs delivered by supplier at the day on store"""
+        delivered = self.__deliveries.pop(day, None)
+        if delivered is not None:
+            delivered = np.concatenate(delivered)
+            self.add_batches(delivered, day)
+            self.__waiting_to_store[delivered] = False
+
+    def order(self, drug_ids, delivery_days):
+        """
+        place reorders at supplier
+
+        :param np.ndarray drug_ids: virtual drugs
+        :param np.ndarray delivery_days: delivery day of every drug
+        """
+        _register(self.__deliveries, delivery_days, drug_ids)
+
+    def take(self, drug_ids, needed):
+        """
+        take units of different virtual drugs from store, old batches go first
+
+        :param np.ndarray drug_ids:
+        :param np.ndarray needed: needed units of every drug
+        :return: np.ndarray number of taken units of every drug
+        """
+        taken = self.drug_store.take_many(drug_ids, needed)
+        self.__changed[drug_ids[taken > 0]] = True
+        return taken
+
+    def check(self, day):
+        """
+        write off overdue batches and check changed virtual drugs for sales and reorders
+
+        :param int day: pharmacy day
+        :return: (np.ndarray, np.ndarray, np.ndarray) - virtual drugs to reorder, to put on sale, to remove sale
+        """
+        if day in self.__expiry_calendar:
+            expired_ids, expired_quants = self.drug_store.expire(day, np.concatenate(self.__expiry_calendar.pop(day)))
+            self.lost += np.bincount(self.group_of[expired_ids], weights=expired_quants * self.base_prices[expired_ids],
+                                     minlength=self.n_groups)
+            self.__changed[expired_ids] = True
+        for sale_day in [sale_day for sale_day in self.__sale_calendar if sale_day <= day]:
+            self.__changed[np.concatenate(self.__sale_calendar.pop(sale_day))] = True
+
+        changed_ids = np.flatnonzero(self.__changed)
+        self.__changed[changed_ids] = False
+        close_to_expiry = self.drug_store.first_valid_to(changed_ids) - day <= DAYS_TO_SALE
+        cur_prices = self.cur_prices[changed_ids]
+        full_prices = self.full_prices[changed_ids]
+        add_sale_ids = changed_ids[close_to_expiry & (cur_prices == full_prices)]
+        remove_sale_ids = changed_ids[~close_to_expiry & (cur_prices < full_prices)]
+
+        to_reorder = ~self.__waiting_to_store[changed_ids] & \
+            (self.drug_store.totals[changed_ids] <= self.__min_quant_to_reorder[changed_ids])
+        reorder_ids = changed_ids[to_reorder]
+        self.__waiting_to_store[reorder_ids] = True
+        return reorder_ids, add_sale_ids, remove_sale_ids
+
+    def update_prices(self, decrease_drugs, increase_drugs):
+        """update prices and demand of virtual drugs after the day"""
+        self.cur_prices[decrease_drugs] = self.full_prices[decrease_drugs] / 2
+        self.cur_profits[decrease_drugs] = self.cur_prices[decrease_drugs] / self.base_prices[decrease_drugs]
+        self.cur_prices[increase_drugs] = self.full_prices[increase_drugs]
+        self.cur_profits[increase_drugs] = self.base_profits[increase_drugs]
+        changed = np.concatenate((decrease_drugs, increase_drugs))
+        self.intensity[changed] = self.__demand_model.intensity(self.base_prices[changed], self.cur_profits[changed])
+
+    def add_batches(self, drug_ids, day):
+        """put standard batches of virtual drugs on store and register them in expiry and sale calendars"""
+        valid_to = day + self.shelf_lives[drug_ids]
+        self.drug_store.push(drug_ids, self.quantities[drug_ids], valid_to)
+        _register(self.__expiry_calendar, valid_to + 1, drug_ids)
+        _register(self.__sale_calendar, valid_to - DAYS_TO_SALE, drug_ids)
+        self.__changed[drug_ids] = True
+
+
+def _register(calendar, days, drug_ids):
+    """
+    add drugs to calendar under their days
+
+    :param dict calendar: dict(day;List[np.ndarray])
+    :param np.ndarray days: day of every drug
+    :param np.ndarray drug_ids:
+    """
+    if not len(drug_ids):
+        return
+    order = np.argsort(days, kind='stable')
+    days = days[order]
+    drug_ids = drug_ids[order]
+    unique_days, starts = np.unique(days, return_index=True)
+    for day, part in zip(unique_days.tolist(), np.split(drug_ids, starts[1:])):
+        calendar.setdefault(day, []).append(part)